@@ -0,0 +1,342 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+
+from SAR_lib import SAR_Project, iter_news, merge_start, news_files, read_manifest, segment_path
+from SAR_postings import Bitmap, Complement, Intervals
+from SAR_profile import PERCENTILES, percentile
+from SAR_query import QuerySyntaxError
+
+
+# campos tokenizados de las noticias
+TEXT_FIELDS = [field for field, tokenized in SAR_Project.fields if tokenized]
+
+# modos de indexacion: nombre --> (opciones de SAR_Indexer.py, buscar con stemming)
+MODES = {'plain': ([], False), 'stem': (['-S'], True), 'permuterm': (['-P'], False), 'multifield': (['-M'], False)}
+
+# secuencias de actualizaciones para comprobar la politica de fusion: nombre --> (numero de actualizacion, random) --> noticias
+UPDATE_PATTERNS = {
+    'constant': lambda u, rng: 100,
+    'alternating': lambda u, rng: (70, 60)[u % 2],  # a ambos lados de 4 ** 3
+    'monthly': lambda u, rng: (69, 50, 35, 76, 92, 51, 2)[u % 7],
+    'uniform': lambda u, rng: rng.randint(1, 100),
+    'skewed': lambda u, rng: int(10 ** rng.uniform(0, 4)),
+    'growing': lambda u, rng: u + 1,
+    'big-first': lambda u, rng: 5000 if u == 0 else rng.randint(1, 5),
+}
+
+
+def reference_tokenize(tokenizer, text):
+    """
+    Tokenizacion original de SAR_Project.tokenize: sustituye los simbolos no alfanumericos por espacios y divide.
+
+    """
+    return tokenizer.sub(' ', text.lower()).split()
+
+
+def bench_tokenize(newsdirs, repeat):
+    """
+    Compara SAR_Project.tokenize y SAR_Project.tokenize_offsets con la tokenizacion original sobre todos
+    los campos tokenizados de las noticias de "newsdirs": deben dar los mismos tokens. Mide el tiempo
+    de cada una (el mejor de "repeat" repeticiones).
+
+    return: diccionario con los resultados, para mostrarlo como JSON
+
+    """
+    project = SAR_Project()
+    texts = []
+    for newsdir in newsdirs:
+        for filename in news_files(newsdir):
+            for new in iter_news(filename):
+                texts.extend(new.get(field) or '' for field in TEXT_FIELDS)
+
+    tokenizer = re.compile(r'\W+')
+    mismatches = 0
+    ntokens = 0
+    for text in texts:
+        tokens = reference_tokenize(tokenizer, text)
+        ntokens += len(tokens)
+        if project.tokenize(text) != tokens or project.tokenize_offsets(text)[0] != tokens:
+            mismatches += 1
+
+    def best(fnc):
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            for text in texts:
+                fnc(text)
+            times.append(time.perf_counter() - t0)
+        return min(times)
+
+    reference = best(lambda text: reference_tokenize(tokenizer, text))
+    tokenize = best(project.tokenize)
+    return {'mode': 'tokenize', 'newsdirs': newsdirs, 'texts': len(texts), 'tokens': ntokens,
+            'identical': mismatches == 0, 'mismatches': mismatches,
+            'reference_s': round(reference, 4), 'tokenize_s': round(tokenize, 4),
+            'tokenize_offsets_s': round(best(project.tokenize_offsets), 4),
+            'speedup': round(reference / tokenize, 2)}
+
+
+def bench_merges(updates, factor):
+    """
+    Simula la indexacion incremental con cada secuencia de UPDATE_PATTERNS (un segmento nuevo por actualizacion,
+    fusionados con merge_start) y comprueba que el numero de segmentos no pasa de factor * (log2(noticias) + 1).
+
+    return: diccionario con los resultados, para mostrarlo como JSON
+
+    """
+    results = []
+    for name, pattern in UPDATE_PATTERNS.items():
+        rng = random.Random(0)
+        segments = []
+        news = written = most = 0
+        bounded = True
+        for u in range(updates):
+            size = pattern(u, rng)
+            segments.append({'news': size})
+            news += size
+            written += size
+            start = merge_start(segments, factor)
+            while start is not None:
+                merged = sum(segment['news'] for segment in segments[start:])
+                written += merged
+                segments[start:] = [{'news': merged}]
+                start = merge_start(segments, factor)
+            most = max(most, len(segments))
+            bounded = bounded and len(segments) <= factor * (math.log2(news) + 1)
+        results.append({'pattern': name, 'news': news, 'segments': len(segments), 'max_segments': most,
+                        'writes_per_news': round(written / news, 2), 'bounded': bounded})
+    return {'mode': 'merges', 'updates': updates, 'factor': factor, 'results': results,
+            'bounded': all(result['bounded'] for result in results)}
+
+
+def run_measured(cmd):
+    """
+    Ejecuta "cmd" en un proceso hijo.
+
+    return: tiempo (s) y memoria maxima (RSS, KB) del proceso
+
+    """
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    elapsed = time.perf_counter() - t0
+    if proc.returncode != 0:
+        raise RuntimeError("'%s' failed with exit code %d" % (' '.join(cmd), proc.returncode))
+    # ru_maxrss esta en KB en Linux y en bytes en macOS
+    return elapsed, usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+
+
+def index_size(indexfile):
+    """
+    return: bytes que ocupa el indice en disco (todos sus segmentos y el manifiesto)
+
+    """
+    manifest = read_manifest(indexfile)
+    if manifest is None:
+        return os.path.getsize(indexfile)
+    files = [segment_path(indexfile, segment['file']) for segment in manifest['segments']]
+    return sum(os.path.getsize(filename) for filename in files + [indexfile + '.manifest'])
+
+
+def read_queries(filename):
+    """
+    return: consultas de un fichero de consultas (queries_*.txt) o de resultados (result_*.txt)
+
+    """
+    with open(filename, encoding='utf-8') as fh:
+        return [line.split('\t')[0] for line in fh.read().split('\n') if len(line) > 0 and not line.startswith('#')]
+
+
+def bench_queries(searcher, queries, repeat):
+    """
+    Mide el tiempo de cada consulta (self.plan_query + self.evaluate, como solve_and_count sin mostrar nada)
+    hasta tener sus newids: los resultados perezosos (Complement de un NOT, Bitmap, Intervals) se materializan.
+    La cache se vacia antes de cada ejecucion, de modo que se mide siempre la consulta completa.
+
+    Solo las consultas no validas (QuerySyntaxError) se cuentan como errores, y se guardan con su mensaje;
+    cualquier otra excepcion es un fallo del buscador e interrumpe la medida.
+
+    return: diccionario con el numero de consultas, de errores, las consultas con error y los percentiles
+            de la latencia (ms)
+
+    """
+    latencies = []
+    errors = 0
+    failed = {}  # consulta --> mensaje de error
+    for _ in range(repeat):
+        for query in queries:
+            searcher.cache.clear()
+            t0 = time.perf_counter()
+            try:
+                result = searcher.evaluate(searcher.plan_query(query))
+                if isinstance(result, (Complement, Bitmap, Intervals)):
+                    result.materialize()
+            except QuerySyntaxError as e:
+                errors += 1
+                failed[query] = str(e)
+                continue
+            latencies.append((time.perf_counter() - t0) * 1000)
+    result = {'queries': len(queries), 'runs': len(latencies), 'errors': errors,
+              'failed': [{'query': query, 'error': error} for query, error in failed.items()]}
+    for q in PERCENTILES:
+        value = percentile(latencies, q)
+        result['p%d_ms' % q] = round(value, 3) if value is not None else None
+    result['mean_ms'] = round(sum(latencies) / len(latencies), 3) if latencies else None
+    return result
+
+
+def bench_run(newsdirs, modes, queryfiles, workdir, repeat, jobs):
+    """
+    Para cada directorio de noticias y modo de indexacion (MODES): crea el indice con SAR_Indexer.py en
+    un proceso aparte (tiempo y memoria maxima), mide su tamaño en disco, el tiempo de carga y la latencia
+    de las consultas de cada fichero de "queryfiles".
+
+    return: diccionario con los resultados, para guardarlo como JSON
+
+    """
+    indexer = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SAR_Indexer.py')
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+    for newsdir in newsdirs:
+        for mode in modes:
+            options, stemming = MODES[mode]
+            indexfile = os.path.join(workdir, '%s.%s.idx' % (os.path.basename(os.path.normpath(newsdir)), mode))
+            build_s, peak_rss_kb = run_measured([sys.executable, indexer] + options + ['-j', str(jobs), newsdir, indexfile])
+            t0 = time.perf_counter()
+            searcher = SAR_Project.load(indexfile)
+            load_s = time.perf_counter() - t0
+            searcher.set_stemming(stemming)
+            result = {'newsdir': newsdir, 'mode': mode, 'options': options, 'build_s': round(build_s, 3),
+                      'peak_rss_kb': peak_rss_kb, 'size_bytes': index_size(indexfile), 'load_s': round(load_s, 4),
+                      'queries': {}}
+            for queryfile in queryfiles:
+                result['queries'][os.path.basename(queryfile)] = bench_queries(searcher, read_queries(queryfile), repeat)
+            results.append(result)
+    return {'mode': 'run', 'version': git_version(), 'python': platform.python_version(),
+            'platform': platform.platform(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'repeat': repeat,
+            'results': results}
+
+
+def git_version():
+    """
+    return: commit actual del repositorio (None si no se puede saber)
+
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_compare(base, new):
+    """
+    Compara dos resultados de bench_run: para cada directorio y modo de ambos muestra el valor de cada
+    medida en los dos y su cociente (nuevo / base; mayor que 1 es una regresion). Si cambia el numero de
+    consultas con error se avisa y se muestran las que fallan ahora.
+
+    """
+    print('%s --> %s' % (base.get('version'), new.get('version')))
+    base_results = {(result['newsdir'], result['mode']): result for result in base['results']}
+    for result in new['results']:
+        old = base_results.get((result['newsdir'], result['mode']))
+        if old is None:
+            continue
+        print('%s %s' % (result['newsdir'], result['mode']))
+        metrics = [(key, old[key], result[key]) for key in ('build_s', 'peak_rss_kb', 'size_bytes', 'load_s')]
+        for queryfile, stats in result['queries'].items():
+            if queryfile in old['queries']:
+                for q in PERCENTILES:
+                    key = 'p%d_ms' % q
+                    metrics.append(('%s %s' % (queryfile, key), old['queries'][queryfile][key], stats[key]))
+                metrics.append(('%s errors' % queryfile, old['queries'][queryfile]['errors'], stats['errors']))
+        for name, a, b in metrics:
+            ratio = '%.2f' % (b / a) if a and b is not None else '-'
+            print('\t%-30s %14s %14s %8s' % (name, a, b, ratio))
+        for queryfile, stats in result['queries'].items():
+            if queryfile in old['queries'] and stats['errors'] != old['queries'][queryfile]['errors']:
+                print('\tWARNING: %s errors changed from %d to %d' % (queryfile, old['queries'][queryfile]['errors'],
+                                                                     stats['errors']))
+                for failure in stats.get('failed', []):
+                    print('\t\t%s: %s' % (failure['query'], failure['error']))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmarks of the indexer and the searcher.')
+    subparsers = parser.add_subparsers(dest='mode', required=True)
+
+    tok = subparsers.add_parser('tokenize', help='check and time the tokenizer against the original one.')
+    tok.add_argument('newsdirs', metavar='newsdir', type=str, nargs='+',
+                     help='directories with the news.')
+    tok.add_argument('-r', '--repeat', dest='repeat', type=int, default=3,
+                     help='number of repetitions, the best time is reported.')
+
+    mrg = subparsers.add_parser('merges', help='check that the segment merge policy keeps few segments.')
+    mrg.add_argument('-u', '--updates', dest='updates', type=int, default=1000,
+                     help='number of simulated updates of each pattern.')
+    mrg.add_argument('-f', '--factor', dest='factor', type=int, default=SAR_Project.MERGE_FACTOR,
+                     help='merge factor (SAR_Project.MERGE_FACTOR by default).')
+
+    run = subparsers.add_parser('run', help='build the index in each mode and time it and the queries.')
+    run.add_argument('newsdirs', metavar='newsdir', type=str, nargs='+',
+                     help='directories with the news.')
+    run.add_argument('-m', '--modes', dest='modes', type=str, default=','.join(MODES),
+                     help='comma separated indexing modes, from: %s.' % ', '.join(MODES))
+    run.add_argument('-q', '--queries', dest='queries', type=str, nargs='+',
+                     default=['queries_minimo.txt', 'queries_full.txt'],
+                     help='files with queries.')
+    run.add_argument('-w', '--workdir', dest='workdir', type=str, default='benchmark',
+                     help='directory for the indexes.')
+    run.add_argument('-r', '--repeat', dest='repeat', type=int, default=3,
+                     help='number of times each query is run.')
+    run.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                     help='number of processes used to index the news.')
+    run.add_argument('-o', '--output', dest='output', type=str, default=None,
+                     help='file to save the results as JSON (standard output by default).')
+
+    cmp = subparsers.add_parser('compare', help='compare two results of "run".')
+    cmp.add_argument('base', type=str, help='JSON file with the base results.')
+    cmp.add_argument('new', type=str, help='JSON file with the new results.')
+
+    args = parser.parse_args()
+
+    if args.mode == 'run':
+        modes = args.modes.split(',')
+        for mode in modes:
+            if mode not in MODES:
+                parser.error("unknown mode '%s'" % mode)
+        result = bench_run(args.newsdirs, modes, args.queries, args.workdir, args.repeat, args.jobs)
+        if args.output is None:
+            print(json.dumps(result, indent=2))
+        else:
+            with open(args.output, 'w', encoding='utf-8') as fh:
+                json.dump(result, fh, indent=2)
+
+    elif args.mode == 'compare':
+        with open(args.base, encoding='utf-8') as fh:
+            base = json.load(fh)
+        with open(args.new, encoding='utf-8') as fh:
+            new = json.load(fh)
+        bench_compare(base, new)
+
+    elif args.mode == 'tokenize':
+        result = bench_tokenize(args.newsdirs, args.repeat)
+        print(json.dumps(result, indent=2))
+        if not result['identical']:
+            sys.exit(1)
+
+    elif args.mode == 'merges':
+        result = bench_merges(args.updates, args.factor)
+        print(json.dumps(result, indent=2))
+        if not result['bounded']:
+            sys.exit(1)
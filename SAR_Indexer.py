@@ -1,5 +1,4 @@
 import argparse
-import pickle
 import sys
 import time
 
@@ -27,19 +26,42 @@ if __name__ == "__main__":
     parser.add_argument('-O', '--positional', dest='positional', action='store_true', default=False, 
                     help='compute positional index.')
 
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                    help='number of processes used to index the news.')
+
+    parser.add_argument('-u', '--update', dest='update', action='store_true', default=False,
+                    help='index only the new or modified files into a new segment of an existing index.')
+
+    parser.add_argument('--merge', dest='merge', choices=['background', 'foreground', 'off'], default='background',
+                    help='how to merge the segments of an updated index (default: background).')
+
+    parser.add_argument('--profile', dest='profile', action='store_true', default=False,
+                    help='show the time, items and bytes of each indexing stage.')
+
     args = parser.parse_args()
 
     newsdir = args.newsdir
     indexfile = args.index
 
     indexer = SAR_Project()
+    indexer.set_profile(args.profile)
+    if args.update:
+        t0 = time.time()
+        indexed, removed = indexer.update_dir(newsdir, indexfile, **vars(args))
+        print("Updated files: %d, removed files: %d" % (indexed, removed))
+        print("Time updating: %2.2fs." % (time.time() - t0))
+        if args.profile:
+            indexer.profiler.report()
+        sys.exit(0)
+
     t0 = time.time()
     indexer.index_dir(newsdir, **vars(args))
     t1 = time.time()
-    with open(indexfile, 'wb') as fh:
-            pickle.dump(indexer, fh)
+    indexer.save_index(indexfile)
     t2 = time.time()
     indexer.show_stats()
     print("Time indexing: %2.2fs." % (t1 - t0))
     print("Time saving: %2.2fs." % (t2 - t1))
-    print()
\ No newline at end of file
+    print()
+    if args.profile:
+        indexer.profiler.report()
\ No newline at end of file
@@ -2,10 +2,24 @@
 
 
 import argparse
-import pickle
 import sys
 
 from SAR_lib import SAR_Project
+from SAR_query import QuerySyntaxError
+
+
+def positive_int(value):
+    """
+    Tipo de argparse: entero mayor o igual que 1.
+
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid int value: '%s'" % value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be >= 1, got %d" % number)
+    return number
 
 
 def syntax():
@@ -40,6 +54,24 @@ if __name__ == "__main__":
     parser.add_argument('-R', '--rank', dest='rank', action='store_true', default=False, 
                     help='rank results. Does not apply with -C and -T options.')
 
+    parser.add_argument('--page', dest='page', metavar='N', type=positive_int, default=None,
+                    help='show only the N-th page of results, stopping the evaluation of unranked queries once it is complete. Does not apply with -A, -C and -T options.')
+
+    parser.add_argument('--page-size', dest='page_size', metavar='M', type=positive_int, default=None,
+                    help='number of results per page (10 by default).')
+
+    parser.add_argument('-E', '--explain', dest='explain', action='store_true', default=False,
+                    help='show the query plan with the number of news and the time of each node.')
+
+    parser.add_argument('--profile', dest='profile', action='store_true', default=False,
+                    help='show the time, posting list sizes and bytes read of each search stage.')
+
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                    help='number of processes used to solve the terms of the queries with -L and -T.')
+
+    parser.add_argument('--cache-size', dest='cache_size', metavar='MB', type=int, default=None,
+                    help='size of the posting list and subquery cache in MB (0 disables it).')
+
 
     group1 = parser.add_mutually_exclusive_group()
     group1.add_argument('-Q', '--query', dest='query', metavar= 'query', type=str, action='store',
@@ -51,13 +83,18 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    with open(args.index, 'rb') as fh:
-        searcher = pickle.load(fh)
+    searcher = SAR_Project.load(args.index)
 
     searcher.set_stemming(args.stem)
     searcher.set_ranking(args.rank)
     searcher.set_showall(args.all)
     searcher.set_snippet(args.snippet)
+    searcher.set_explain(args.explain)
+    searcher.set_profile(args.profile)
+    if args.page is not None or args.page_size is not None:
+        searcher.set_page(args.page if args.page is not None else 1, args.page_size)
+    if args.cache_size is not None:
+        searcher.set_cache_size(args.cache_size << 20)
 
 
     # se debe contar o mostrar resultados?
@@ -71,35 +108,62 @@ if __name__ == "__main__":
 
         with open(args.test, encoding='utf-8') as fh:
             lines = fh.read().split('\n')
+            # todas las consultas se resuelven en un lote (solve_batch), compartiendo las subconsultas comunes
+            tests = [line.split('\t') for line in lines if len(line) > 0 and not line.startswith('#')]
+            batch = searcher.solve_batch([query for query, reference in tests], args.jobs)
             for line in lines:
                 if len(line) > 0 and not line.startswith('#'):
-                    query, reference = line.split('\t')
-                    reference = int(reference)
-                    result = searcher.solve_and_count(query)
+                    query, plan = next(batch)
+                    if isinstance(plan, QuerySyntaxError):
+                        print("==> ERROR: %s" % plan)
+                        sys.exit(-1)
+                    reference = int(line.split('\t')[1])
+                    result = searcher.solve_and_count(query, plan)
                     if result != reference:
                         print("==> ERROR: '%s'\t%d\t%d" % (query, result, reference))
                         sys.exit(-1)
                 else:
                     print(line)
+            print()
+            searcher.show_cache_stats()
             print('\nParece que todo ha ido bien, buen trabajo!')
 
     elif args.query is not None:
         # opt: -Q, una query pasada como argumento
-        fnc(args.query) # searcher.solve_and_show(args.query)
+        try:
+            fnc(args.query) # searcher.solve_and_show(args.query)
+        except QuerySyntaxError as e:
+            print("==> ERROR: %s" % e)
+            sys.exit(-1)
+        if args.explain:
+            searcher.show_cache_stats()
 
     elif args.qlist is not None:
         # opt: -L, una lista de queries
         with open(args.qlist, encoding='utf-8') as fh:
             queries = fh.read().split('\n')
             queries.pop()
+            batch = searcher.solve_batch([query for query in queries if len(query) > 0 and not query.startswith('#')],
+                                         args.jobs)
             for query in queries:
                 if len(query) > 0 and not query.startswith('#'):
-                    fnc(query)
+                    query, plan = next(batch)
+                    if isinstance(plan, QuerySyntaxError):
+                        print("==> ERROR: %s" % plan)
+                    else:
+                        fnc(query, plan)
                 else:
                     print(query)
+            searcher.show_cache_stats()
     else:
         # modo interactivo
         query = input("query:")
         while query != "":
-            fnc(query)
-            query = input("query:")
\ No newline at end of file
+            try:
+                fnc(query)
+            except QuerySyntaxError as e:
+                print("==> ERROR: %s" % e)
+            query = input("query:")
+
+    if args.profile:
+        searcher.profiler.report()
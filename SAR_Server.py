@@ -0,0 +1,318 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+from SAR_lib import SAR_Project
+from SAR_profile import PERCENTILES, percentile
+
+# Servidor de busqueda: carga el indice una vez y responde consultas por HTTP (en local, TCP o socket Unix).
+#
+#   GET /search?q=<consulta>[&stem=1][&rank=1][&page=N][&size=M][&fields=1][&snippet=1]
+#       --> {"query", "total", "total_exact", "page", "results": [{"newid", "score", "doc_id", "position"[, "fields"][, "snippet"]}]}
+#   GET /count?q=<consulta>[&stem=1]  --> {"query", "count"}
+#   GET /metrics  --> peticiones, errores, rechazadas, cola, latencias (percentiles) y cache
+#   GET /health   --> {"status": "ok"}
+#
+# Tambien se aceptan peticiones POST a /search y /count con los parametros en un objeto JSON.
+#
+# SAR_Project no admite consultas concurrentes (la cache y las opciones son del objeto), asi que las
+# consultas se encolan (cola acotada: si esta llena se responde 503) y las resuelve de una en una un
+# hilo aparte, mientras el bucle de asyncio sigue aceptando conexiones y respondiendo a /metrics.
+
+MAX_REQUEST_BYTES = 1 << 16
+LATENCY_WINDOW = 1000  # latencias guardadas para /metrics (las ultimas)
+READ_TIMEOUT = 10
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+            413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def flag(params, name):
+    return str(params.get(name, '0')).lower() in ('1', 'true', 'yes')
+
+
+def positive_int(params, name, default=None):
+    """
+    Parametro entero mayor o igual que 1 (en la URL como cadena o en el JSON como numero).
+
+    return: su valor o "default" si no esta
+
+    """
+    if name not in params:
+        return default
+    value = params[name]
+    if isinstance(value, str) and value.strip().isdecimal():
+        value = int(value)
+    if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+        raise HTTPError(400, "parameter '%s' must be an integer >= 1, got %s" % (name, json.dumps(params[name])))
+    return value
+
+
+class SearchServer:
+    """
+    Servidor HTTP de consultas sobre un SAR_Project ya cargado.
+
+    """
+
+    def __init__(self, project, queue_size):
+        self.project = project
+        self.queue = asyncio.Queue(queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=1)  # un unico hilo resuelve las consultas
+        self.latencies = deque(maxlen=LATENCY_WINDOW)  # tiempo total de cada consulta (cola + resolucion), ms
+        self.service = deque(maxlen=LATENCY_WINDOW)  # tiempo de resolucion de cada consulta, ms
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.started = time.time()
+
+    async def worker(self):
+        """
+        Resuelve las consultas de la cola, de una en una, en el hilo de self.executor.
+
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            fnc, params, future = await self.queue.get()
+            t0 = time.perf_counter()
+            try:
+                result = await loop.run_in_executor(self.executor, fnc, params)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            self.service.append((time.perf_counter() - t0) * 1000)
+            self.queue.task_done()
+
+    async def submit(self, fnc, params):
+        """
+        Encola una consulta y espera su resultado.
+
+        """
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((fnc, params, future))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise HTTPError(503, 'request queue is full (%d requests)' % self.queue.maxsize)
+        t0 = time.perf_counter()
+        result = await future
+        self.latencies.append((time.perf_counter() - t0) * 1000)
+        return result
+
+    def configure(self, params):
+        project = self.project
+        project.set_stemming(flag(params, 'stem'))
+        project.set_ranking(flag(params, 'rank'))
+        project.set_showall(False)
+        project.set_snippet(flag(params, 'snippet'))
+        if 'page' in params or 'size' in params:
+            project.set_page(positive_int(params, 'page', 1), positive_int(params, 'size'))
+        else:
+            project.set_page(None)
+
+    def search(self, params):
+        """
+        Resuelve una consulta y devuelve las noticias seleccionadas (como SAR_Project.solve_and_show).
+
+        """
+        project = self.project
+        self.configure(params)
+        query = params['q']
+        plan = project.plan_query(query)
+        shown, nresults, exact, start = project.select_results(plan, query)
+        snippet_terms = project.snippet_terms(query) if project.show_snippet else []
+        results = []
+        for newid, score in shown:
+            doc_id, position = project.news[newid]
+            result = {'newid': newid, 'score': round(score, 3), 'doc_id': doc_id, 'position': position}
+            if flag(params, 'fields'):
+                result['fields'] = project.get_news(newid)
+            if project.show_snippet:
+                result['snippet'] = project.make_snippet(newid, snippet_terms)
+            results.append(result)
+        # sin ranking, con paginas, solo se sabe que hay al menos "total" noticias (total_exact = False)
+        return {'query': query, 'total': nresults, 'total_exact': exact, 'page': project.page, 'results': results}
+
+    def count(self, params):
+        self.configure(params)
+        query = params['q']
+        return {'query': query, 'count': len(self.project.evaluate(self.project.plan_query(query)))}
+
+    def metrics(self):
+        cache = self.project.cache
+        latency = list(self.latencies)
+        service = list(self.service)
+        result = {'requests': self.requests, 'errors': self.errors, 'rejected': self.rejected,
+                  'queue': {'size': self.queue.qsize(), 'max': self.queue.maxsize},
+                  'uptime_s': round(time.time() - self.started, 3), 'window': len(latency),
+                  'latency_ms': {}, 'service_ms': {},
+                  'cache': {'hits': cache.hits, 'misses': cache.misses, 'entries': len(cache.entries),
+                            'bytes': cache.bytes}}
+        for name, values in (('latency_ms', latency), ('service_ms', service)):
+            for q in PERCENTILES:
+                value = percentile(values, q)
+                result[name]['p%d' % q] = round(value, 3) if value is not None else None
+            result[name]['mean'] = round(sum(values) / len(values), 3) if values else None
+        return result
+
+    async def route(self, method, target, body):
+        url = urlsplit(target)
+        if url.path in ('/search', '/count'):
+            if method == 'GET':
+                params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            elif method == 'POST':
+                try:
+                    params = json.loads(body or b'{}')
+                except ValueError:
+                    raise HTTPError(400, 'invalid JSON body')
+                if not isinstance(params, dict):
+                    raise HTTPError(400, 'the JSON body must be an object')
+            else:
+                raise HTTPError(405, 'method %s not allowed' % method)
+            if not params.get('q'):
+                raise HTTPError(400, "missing parameter 'q'")
+            self.requests += 1
+            try:
+                return await self.submit(self.search if url.path == '/search' else self.count, params)
+            except ValueError as e:
+                # SAR_query.QuerySyntaxError o parametros no validos
+                raise HTTPError(400, str(e))
+        if method != 'GET':
+            raise HTTPError(405, 'method %s not allowed' % method)
+        if url.path == '/metrics':
+            return self.metrics()
+        if url.path == '/health':
+            return {'status': 'ok', 'news': len(self.project.news)}
+        raise HTTPError(404, 'unknown path %s' % url.path)
+
+    async def handle(self, reader, writer):
+        """
+        Atiende una conexion: una peticion HTTP/1.1 y su respuesta JSON.
+
+        """
+        status = 200
+        try:
+            try:
+                method, target, body = await asyncio.wait_for(read_request(reader), READ_TIMEOUT)
+                response = await self.route(method, target, body)
+            except HTTPError as e:
+                status = e.status
+                response = {'error': str(e)}
+            except asyncio.TimeoutError:
+                status = 400
+                response = {'error': 'timeout reading the request'}
+            except Exception as e:
+                status = 500
+                response = {'error': '%s: %s' % (type(e).__name__, e)}
+            if status >= 400 and status != 503:  # las rechazadas se cuentan en self.rejected
+                self.errors += 1
+            data = json.dumps(response, ensure_ascii=False).encode('utf-8')
+            writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: application/json; charset=utf-8\r\n'
+                         b'Content-Length: %d\r\nConnection: close\r\n\r\n' % (status, _REASONS[status].encode(), len(data)))
+            writer.write(data)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def read_request(reader):
+    """
+    Lee una peticion HTTP.
+
+    return: metodo, destino (ruta y parametros) y cuerpo
+
+    """
+    line = await reader.readline()
+    parts = line.decode('latin-1').split()
+    if len(parts) != 3:
+        raise HTTPError(400, 'malformed request line')
+    method, target, version = parts
+    length = 0
+    size = len(line)
+    while True:
+        line = await reader.readline()
+        size += len(line)
+        if size > MAX_REQUEST_BYTES:
+            raise HTTPError(413, 'request too large')
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            try:
+                length = int(value)
+            except ValueError:
+                raise HTTPError(400, 'invalid Content-Length')
+    if length > MAX_REQUEST_BYTES:
+        raise HTTPError(413, 'request too large')
+    body = await reader.readexactly(length) if length > 0 else b''
+    return method, target, body
+
+
+async def serve(project, args):
+    server = SearchServer(project, args.queue_size)
+    worker = asyncio.create_task(server.worker())
+    if args.unix is not None:
+        if os.path.exists(args.unix):
+            os.remove(args.unix)
+        listener = await asyncio.start_unix_server(server.handle, path=args.unix)
+        print('Serving on unix:%s' % args.unix, flush=True)
+    else:
+        listener = await asyncio.start_server(server.handle, args.host, args.port)
+        print('Serving on http://%s:%d' % listener.sockets[0].getsockname()[:2], flush=True)
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        worker.cancel()
+        server.executor.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Serve queries over HTTP with the index loaded once.')
+
+    parser.add_argument('index', metavar='index', type=str,
+                        help='name of the file with the index object.')
+
+    parser.add_argument('--host', dest='host', type=str, default='127.0.0.1',
+                        help='address to listen on (127.0.0.1 by default).')
+
+    parser.add_argument('--port', dest='port', type=int, default=8000,
+                        help='TCP port to listen on (8000 by default, 0 chooses a free one).')
+
+    parser.add_argument('--unix', dest='unix', metavar='PATH', type=str, default=None,
+                        help='listen on a Unix socket instead of TCP.')
+
+    parser.add_argument('--queue-size', dest='queue_size', type=int, default=64,
+                        help='maximum number of queued queries, more are rejected with 503 (64 by default).')
+
+    parser.add_argument('--cache-size', dest='cache_size', metavar='MB', type=int, default=None,
+                        help='size of the posting list and subquery cache in MB (0 disables it).')
+
+    args = parser.parse_args()
+
+    t0 = time.time()
+    project = SAR_Project.load(args.index)
+    if args.cache_size is not None:
+        project.set_cache_size(args.cache_size << 20)
+    print('Index loaded in %.3fs: %d news' % (time.time() - t0, len(project.news)), flush=True)
+    try:
+        asyncio.run(serve(project, args))
+    except KeyboardInterrupt:
+        pass
@@ -1,7 +1,32 @@
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import hashlib
+import heapq
+from itertools import groupby, islice
 import json
+import math
 from nltk.stem.snowball import SnowballStemmer
 import os
+import pickle
 import re
+import subprocess
+import sys
+import time
+import zlib
+
+from SAR_postings import (Bitmap, Complement, Intervals, PermutermIndex, PositionList, PostingCache, PostingList, SortedTermDict,
+                          decode_posting, encode_posting, gallop, merge_postings)
+from SAR_profile import INDEX_STAGES, QUERY_STAGES, Profiler
+from SAR_query import And, Diff, Not, Or, Phrase, QuerySyntaxError, Range, Term, optimize, parse_query
+from SAR_segment import (Segment, SegmentBlobs, SegmentConcat, SegmentDict, SegmentFieldIndex, SegmentLists,
+                         SegmentPositions, SegmentStrings, SegmentTable, SegmentTerms, SegmentUnion, SegmentWriter,
+                         is_segment, section_sizes)
+
+
+# extensiones de los ficheros de noticias: JSON Arrays o JSON Lines
+NEWS_EXTENSIONS = ('.json', '.jsonl')
 
 
 class SAR_Project:
@@ -22,9 +47,37 @@ class SAR_Project:
               ("keywords", True), ("article", True),
               ("summary", True)]
 
+    # campos de cada noticia que se guardan comprimidos al indexar (self.store) para mostrar los resultados
+    STORED_FIELDS = ("title", "date", "keywords", "summary")
+
+    # terminos de 'article' que se muestran en cada snippet (self.make_snippet)
+    SNIPPET_TOKENS = 30
+
     # numero maximo de documento a mostrar cuando self.show_all es False
     SHOW_MAX = 10
 
+    # and_posting usa busqueda exponencial cuando una posting list es GALLOP_RATIO veces mas larga que la otra
+    GALLOP_RATIO = 8
+
+    # make_stemming guarda la posting list de los stems con varios terminos que suman al menos STEM_POSTING_MIN postings
+    STEM_POSTING_MIN = 32
+
+    # make_bitmaps guarda como Bitmap la posting list de los terminos que estan en al menos una de cada BITMAP_RATIO
+    # noticias (el Bitmap ocupa entonces menos que la posting list comprimida, al menos 1 byte por newid)
+    # y en al menos BITMAP_MIN_DF noticias
+    BITMAP_RATIO = 8
+    BITMAP_MIN_DF = 32
+
+    # tamaño maximo (bytes) de la cache de posting lists y subconsultas, se cambia con self.set_cache_size()
+    CACHE_BYTES = 64 << 20
+
+    # politica de fusion de segmentos de la indexacion incremental (ver merge_start)
+    MERGE_FACTOR = 4
+
+    # parametros de BM25 para el ranking (self.rank)
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+
     def __init__(self):
         """
         Constructor de la classe SAR_Indexer.
@@ -34,20 +87,40 @@ class SAR_Project:
         Puedes añadir más variables si las necesitas 
 
         """
-        self.index = {}  # hash para el indice invertido de terminos --> clave: termino, valor: posting list.
-        # Si se hace la implementacion multifield, se pude hacer un segundo nivel de hashing de tal forma que:
-        # self.index['title'] seria el indice invertido del campo 'title'.
+        self.index = {}  # hash para el indice invertido de terminos --> clave: termino, valor: posting list (PostingList).
+        self.findex = {'article': self.index}  # indices invertidos por campo --> clave: campo, valor: indice invertido del campo.
+        # Sin multifield solo se indexa 'article' (self.index). Los campos no tokenizados ('date') se guardan
+        # con las claves ordenadas (SortedTermDict) para buscar prefijos y rangos sin recorrerlos.
         self.sindex = {}  # hash para el indice invertido de stems --> clave: stem, valor: lista con los terminos que tienen ese stem
+        self.spostings = {}  # hash de posting lists precalculadas de los stems con muchas noticias --> clave: stem, valor: posting list
         self.ptindex = {}  # hash para el indice permuterm.
+        self.pindex = {}  # hash para el indice posicional --> clave: termino, valor: PositionList con las posiciones en cada noticia de su posting list
+        self.fpindex = {'article': self.pindex}  # indices posicionales por campo (solo campos tokenizados)
+        self.fbitmaps = {}  # posting lists de los terminos frecuentes como Bitmap --> clave: campo, valor: hash termino --> Bitmap
+        self.dindex = {}  # indice de fechas (multifield) --> clave: fecha, valor: array [inicio0, fin0, inicio1, fin1, ...] con los intervalos de newids consecutivos de esa fecha
         self.docs = {}  # diccionario de documentos --> clave: entero(docid),  valor: ruta del fichero.
-        self.weight = {}  # hash de terminos para el pesado, ranking de resultados. puede no utilizarse
+        self.weight = {}  # hash de terminos para el pesado, ranking de resultados --> clave: termino, valor: array con la frecuencia del termino en cada noticia de su posting list ('article')
+        self.lengths = array('I')  # numero de terminos de 'article' de cada noticia, indexado por newid
+        self.store = []  # campos STORED_FIELDS de cada noticia (JSON comprimido con zlib), indexado por newid
+        self.articles = []  # con self.positional, texto de 'article' de cada noticia comprimido con zlib, indexado por newid
+        self.toffsets = []  # con self.positional, caracter en el que empieza cada token de 'article' (encode_posting), indexado por newid
+        self.avgdl = None  # longitud media de 'article', se calcula en la primera consulta con ranking
         self.news = {}  # hash de noticias --> clave entero (newid), valor: la info necesaria para diferenciar la noticia dentro de su fichero (doc_id y posición dentro del documento)
-        self.tokenizer = re.compile("\W+")  # expresion regular para hacer la tokenizacion
+        self.tokenizer = re.compile(r"\W+")  # expresion regular para hacer la tokenizacion
+        self.word = re.compile(r"\w+")  # expresion regular de un token (self.tokenize, self.tokenize_offsets)
         self.stemmer = SnowballStemmer('spanish')  # stemmer en castellano
+        self.stems = {}  # stems ya calculados en las consultas --> clave: termino, valor: stem
         self.show_all = False  # valor por defecto, se cambia con self.set_showall()
         self.show_snippet = False  # valor por defecto, se cambia con self.set_snippet()
         self.use_stemming = False  # valor por defecto, se cambia con self.set_stemming()
         self.use_ranking = False  # valor por defecto, se cambia con self.set_ranking()
+        self.show_explain = False  # valor por defecto, se cambia con self.set_explain()
+        self.page = None  # pagina de resultados a mostrar (desde 1), None muestra los SHOW_MAX primeros; se cambia con self.set_page()
+        self.page_size = self.SHOW_MAX  # resultados por pagina, se cambia con self.set_page()
+        self.cache = PostingCache(self.CACHE_BYTES)  # cache LRU de resultados, clave: (stemming, subconsulta normalizada)
+        self.indexfile = None  # fichero del que se ha cargado el indice (self.load), para abrirlo en otros procesos
+        self.disk_bytes = {}  # bytes en disco de cada seccion del segmento guardado o abierto (self.save, self.open_segment)
+        self.profiler = None  # SAR_profile.Profiler con los tiempos de cada etapa, se activa con self.set_profile()
 
     ###############################
     ###                         ###
@@ -111,6 +184,61 @@ class SAR_Project:
         """
         self.use_ranking = v
 
+    def set_explain(self, v):
+        """
+
+        Cambia el modo de mostrar el plan de las consultas.
+
+        input: "v" booleano.
+
+        si self.show_explain es True se mostrara el plan de cada consulta con el numero de noticias y el tiempo de cada nodo
+
+        """
+        self.show_explain = v
+
+    def set_cache_size(self, v):
+        """
+
+        Cambia el tamaño maximo de la cache de posting lists y subconsultas.
+
+        input: "v" numero de bytes, 0 desactiva la cache.
+
+        """
+        self.cache = PostingCache(v)
+
+    def set_profile(self, v):
+        """
+
+        Activa el perfilado por etapas (SAR_profile): tiempo, elementos y bytes de cada etapa de la
+        indexacion y de las consultas. Se muestra con self.profiler.report().
+
+        input: "v" booleano. Una vez activado no se puede desactivar.
+
+        """
+        if v and self.profiler is None:
+            self.profiler = Profiler()
+            self.profiler.instrument(self, dict(INDEX_STAGES, **QUERY_STAGES))
+
+    def set_page(self, page, page_size=None):
+        """
+
+        Cambia la pagina de resultados que se muestra.
+
+        input: "page" numero de pagina (desde 1), "page_size" resultados por pagina (SHOW_MAX por defecto).
+
+        con una pagina las consultas sin ranking se evaluan de forma perezosa (self.iter_node) y la evaluacion
+        se detiene en cuanto se completa la pagina. No aplicable con self.show_all.
+
+        Lanza ValueError si "page" o "page_size" son menores que 1.
+
+        """
+        if page is not None and page < 1:
+            raise ValueError('page must be >= 1, got %d' % page)
+        if page_size is not None and page_size < 1:
+            raise ValueError('page size must be >= 1, got %d' % page_size)
+        self.page = page
+        self.page_size = page_size if page_size is not None else self.SHOW_MAX
+
     ###############################
     ###                         ###
     ###   PARTE 1: INDEXACION   ###
@@ -130,12 +258,35 @@ class SAR_Project:
         self.positional = args['positional']
         self.stemming = args['stem']
         self.permuterm = args['permuterm']
+        jobs = args.get('jobs') or 1
 
-        for dir, subdirs, files in os.walk(root):
-            for filename in files:
-                if filename.endswith('.json'):
-                    fullname = os.path.join(dir, filename)
-                    self.index_file(fullname)
+        self.index_files(news_files(root), jobs)
+        self.finish_index()
+
+    def index_files(self, filenames, jobs=1):
+        """
+        Indexa "filenames" en orden, con "jobs" procesos si es mayor que 1 (ver self.index_files_parallel).
+
+        """
+        if jobs > 1 and len(filenames) > 1:
+            self.index_files_parallel(filenames, jobs)
+        else:
+            for fullname in filenames:
+                self.index_file(fullname)
+
+    def finish_index(self):
+        """
+        Completa el indice despues de indexar los ficheros: ordena las claves de los campos no tokenizados
+        y crea los indices de stems y permuterm si se han pedido.
+
+        """
+        # los campos no tokenizados se consultan por prefijo (date:2015-03*) y por rango (date:[... TO ...]),
+        # se ordenan sus claves
+        for field, tokenized in self.fields:
+            if not tokenized and field in self.findex:
+                self.findex[field] = SortedTermDict(self.findex[field])
+        self.dindex = SortedTermDict(self.dindex)
+        self.make_bitmaps()
 
         ##########################################
         ## COMPLETAR PARA FUNCIONALIDADES EXTRA ##
@@ -151,6 +302,286 @@ class SAR_Project:
             self.make_permuterm()
         ####
 
+    def update_dir(self, root, indexfile, **args):
+        """
+        Indexacion incremental: indexa solo los ficheros de "root" nuevos o modificados desde la ultima
+        indexacion de "indexfile" y los guarda en un segmento nuevo, sin reconstruir el indice.
+
+        El manifiesto del indice (ver read_manifest) guarda la firma de cada fichero indexado (mtime, tamaño
+        y sha1, que solo se calcula si cambia el mtime). Las noticias de los ficheros modificados o borrados
+        se marcan como borradas (tombstones) y los ficheros nuevos o modificados se indexan con newids a
+        continuacion de los ya asignados, que no cambian.
+
+        param:  "root": directorio con las noticias
+                "indexfile": indice creado con SAR_Indexer.py
+                "merge" (en "args"): 'background' (por defecto) fusiona los segmentos en otro proceso si lo pide
+                la politica de fusion (ver merge_start), 'foreground' en este proceso y 'off' no los fusiona
+
+        return: numero de ficheros indexados y numero de ficheros cuyas noticias se han borrado
+
+        """
+        jobs = args.get('jobs') or 1
+        with manifest_lock(indexfile):
+            manifest = read_manifest(indexfile)
+            if manifest is None:
+                raise ValueError("'%s' has no manifest, index the news without --update first" % indexfile)
+            for key, value in manifest['config'].items():
+                setattr(self, key, value)
+
+            files = manifest['files']
+            filenames = []
+            signatures = {}
+            seen = set()
+            for filename in news_files(root):
+                key = os.path.abspath(filename)
+                seen.add(key)
+                old = files.get(key)
+                stat = os.stat(filename)
+                if old is not None and old['mtime'] == stat.st_mtime and old['size'] == stat.st_size:
+                    continue
+                signatures[key] = file_signature(filename)
+                if old is not None and old['size'] == stat.st_size and old['sha1'] == signatures[key]['sha1']:
+                    old['mtime'] = stat.st_mtime  # mismo contenido
+                    continue
+                filenames.append(filename)
+
+            removed = [key for key in files if key not in seen]
+            deleted = manifest['deleted']
+            for key in [os.path.abspath(filename) for filename in filenames] + removed:
+                old = files.pop(key, None)
+                if old is not None:
+                    deleted.extend((old['first'], old['first'] + old['news']))
+
+            if len(filenames) > 0:
+                self.index_files(filenames, jobs)
+                self.finish_index()
+                segment = '%s.%d' % (indexfile, manifest['next'])
+                manifest['next'] += 1
+                self.save(segment)
+                self.add_to_manifest(manifest, segment, signatures)
+            write_manifest(indexfile, manifest)
+        if args.get('merge', 'background') != 'off' and merge_start(manifest['segments'], self.MERGE_FACTOR) is not None:
+            if args.get('merge') == 'foreground':
+                self.merge_index(indexfile)
+            else:
+                self.merge_in_background(indexfile)
+        return len(filenames), len(removed)
+
+    @classmethod
+    def merge_in_background(cls, indexfile):
+        """
+        Lanza self.merge_index en un proceso independiente, que sigue aunque termine el que lo lanza.
+
+        """
+        code = 'import sys; sys.path.insert(0, sys.argv[1]); import SAR_lib; SAR_lib.SAR_Project.merge_index(sys.argv[2])'
+        subprocess.Popen([sys.executable, '-c', code, os.path.dirname(os.path.abspath(__file__)), indexfile],
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, start_new_session=True)
+
+    def add_to_manifest(self, manifest, segment, signatures=None):
+        """
+        Añade al manifiesto el segmento "segment" con las noticias de self, que tendran los newids
+        (y doc_ids) siguientes a los del indice, y las firmas de sus ficheros.
+
+        param:  "manifest": manifiesto del indice
+                "segment": fichero en el que se ha guardado self
+                "signatures": firmas ya calculadas, clave: ruta absoluta del fichero
+
+        """
+        counts = [0] * len(self.docs)
+        for new_id in range(len(self.news)):
+            counts[self.news[new_id][0]] += 1
+        first = manifest['news']
+        for doc_id in range(len(self.docs)):
+            key = os.path.abspath(self.docs[doc_id])
+            signature = (signatures or {}).get(key) or file_signature(self.docs[doc_id])
+            manifest['files'][key] = dict(signature, first=first, news=counts[doc_id])
+            first += counts[doc_id]
+        manifest['segments'].append({'file': os.path.basename(segment), 'docs': len(self.docs), 'news': len(self.news)})
+        manifest['docs'] += len(self.docs)
+        manifest['news'] += len(self.news)
+
+    def save_index(self, indexfile):
+        """
+        Guarda un indice completo: el segmento en "indexfile" y un manifiesto nuevo con ese unico segmento,
+        para poder actualizarlo despues con self.update_dir. Borra los segmentos de actualizaciones anteriores.
+
+        """
+        with manifest_lock(indexfile):
+            old = read_manifest(indexfile)
+            self.save(indexfile)
+            manifest = new_manifest({'multifield': self.multifield, 'positional': self.positional,
+                                     'stemming': self.stemming, 'permuterm': self.permuterm})
+            self.add_to_manifest(manifest, indexfile)
+            write_manifest(indexfile, manifest)
+        if old is not None:
+            for segment in old['segments']:
+                if segment['file'] != os.path.basename(indexfile):
+                    remove_segment(indexfile, segment['file'])
+
+    @classmethod
+    def merge_index(cls, indexfile):
+        """
+        Fusiona en uno los ultimos segmentos de un indice incremental si lo pide la politica de fusion
+        (merge_start). Se repite mientras haya segmentos que fusionar.
+
+        El segmento fusionado se construye sin bloquear el manifiesto (los segmentos no cambian una vez
+        escritos), asi que las busquedas y actualizaciones pueden seguir mientras tanto; al terminar se
+        sustituyen en el manifiesto, si siguen en el, los segmentos fusionados por el nuevo. Los newids no cambian.
+
+        return: numero de segmentos fusionados
+
+        """
+        merged = 0
+        while True:
+            manifest = read_manifest(indexfile)
+            start = merge_start(manifest['segments'], cls.MERGE_FACTOR)
+            if start is None:
+                return merged
+            names = [segment['file'] for segment in manifest['segments'][start:]]
+
+            project = cls()
+            for key, value in manifest['config'].items():
+                setattr(project, key, value)
+            for name in names:
+                project.merge_partial(cls.open_segment(segment_path(indexfile, name)).export_partial())
+            project.finish_index()
+            tmp = '%s.merging.%d' % (indexfile, os.getpid())
+            project.save(tmp)
+
+            with manifest_lock(indexfile):
+                manifest = read_manifest(indexfile)
+                current = [segment['file'] for segment in manifest['segments'][start:start + len(names)]]
+                if current != names:
+                    # otro proceso ha cambiado los segmentos mientras tanto
+                    os.remove(tmp)
+                    return merged
+                if start == 0:
+                    # se fusionan todos: el resultado vuelve a ser el fichero del indice
+                    segment = indexfile
+                else:
+                    segment = '%s.%d' % (indexfile, manifest['next'])
+                    manifest['next'] += 1
+                os.replace(tmp, segment)
+                manifest['segments'][start:start + len(names)] = [
+                    {'file': os.path.basename(segment), 'docs': len(project.docs), 'news': len(project.news)}]
+                write_manifest(indexfile, manifest)
+            # los procesos que ya tienen abiertos los segmentos antiguos (mmap) pueden seguir usandolos
+            for name in names:
+                remove_segment(indexfile, name)
+            merged += len(names)
+
+    def index_files_parallel(self, filenames, jobs):
+        """
+        Indexa "filenames" repartiendolos entre "jobs" procesos.
+
+        Los ficheros se dividen en bloques consecutivos; cada proceso indexa sus bloques en un
+        SAR_Project vacio (ver _index_files) y el proceso principal los mezcla en orden con
+        self.merge_partial, de modo que los doc_id y new_id coinciden con los de la indexacion secuencial.
+
+        """
+        nchunks = min(len(filenames), jobs * 4)
+        size = -(-len(filenames) // nchunks)
+        chunks = [filenames[i:i + size] for i in range(0, len(filenames), size)]
+        config = {'multifield': self.multifield, 'positional': self.positional,
+                  'stemming': self.stemming, 'permuterm': self.permuterm}
+
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            for partial in pool.map(_index_files, [(chunk, config) for chunk in chunks]):
+                self.merge_partial(partial)
+
+    def export_partial(self):
+        """
+        Devuelve las tablas construidas por index_file en un formato barato de enviar entre procesos
+        (las posting lists de cada campo se concatenan en un unico array).
+
+        return: diccionario con "docs", "news", "news_lengths", "store", "articles", "toffsets", "dates" y "fields";
+                para cada campo "terms", "lengths",
+                "postings" y "positions" (y "weights" en 'article')
+
+        """
+        fields = {}
+        for field, index in self.findex.items():
+            terms = list(index)
+            postings = PostingList()
+            lengths = array('I')
+            for term in terms:
+                postings.extend(index[term])
+                lengths.append(len(index[term]))
+            pindex = self.fpindex.get(field) if self.positional else None
+            if pindex is not None:
+                positions = [pindex[term] for term in terms]
+                positions = [PositionList(array('I', p.offsets), bytearray(p.data)) for p in positions]
+            else:
+                positions = None
+            fields[field] = {'terms': terms, 'lengths': lengths, 'postings': postings.tobytes(), 'positions': positions}
+        weights = array('I')
+        for term in fields['article']['terms']:
+            weights.extend(self.weight[term])
+        fields['article']['weights'] = weights.tobytes()
+        # las tablas se copian para que tambien se pueda exportar un segmento abierto con self.load
+        return {'docs': [self.docs[doc_id] for doc_id in range(len(self.docs))],
+                'news': [self.news[new_id] for new_id in range(len(self.news))],
+                'fields': fields, 'news_lengths': array('I', self.lengths),
+                'dates': {date: array('I', runs) for date, runs in self.dindex.items()},
+                'store': [bytes(self.store[i]) for i in range(len(self.store))],
+                'articles': [bytes(self.articles[i]) for i in range(len(self.articles))],
+                'toffsets': [bytes(self.toffsets[i]) for i in range(len(self.toffsets))]}
+
+    def merge_partial(self, partial):
+        """
+        Añade al indice las tablas devueltas por export_partial de otro SAR_Project,
+        desplazando sus doc_id y new_id a continuacion de los ya indexados.
+
+        param:  "partial": resultado de export_partial
+
+        """
+        doc_base = len(self.docs)
+        new_base = len(self.news)
+        for doc_id, filename in enumerate(partial['docs']):
+            self.docs[doc_base + doc_id] = filename
+        for new_id, (doc_id, pos) in enumerate(partial['news']):
+            self.news[new_base + new_id] = (doc_base + doc_id, pos)
+
+        self.lengths.extend(partial['news_lengths'])
+        self.store.extend(partial['store'])
+        self.articles.extend(partial['articles'])
+        self.toffsets.extend(partial['toffsets'])
+        for date, runs in partial['dates'].items():
+            for start, end in zip(runs[::2], runs[1::2]):
+                self.add_date(date, new_base + start, new_base + end)
+
+        for field, tables in partial['fields'].items():
+            index = self.findex.setdefault(field, {})
+            postings = PostingList()
+            postings.frombytes(tables['postings'])
+            start = 0
+            for term, length in zip(tables['terms'], tables['lengths']):
+                shifted = PostingList(new_id + new_base for new_id in postings[start:start + length])
+                start += length
+                if term not in index:
+                    index[term] = shifted
+                else:
+                    index[term].extend(shifted)
+
+            if field == 'article':
+                weights = array('I')
+                weights.frombytes(tables['weights'])
+                start = 0
+                for term, length in zip(tables['terms'], tables['lengths']):
+                    if term not in self.weight:
+                        self.weight[term] = weights[start:start + length]
+                    else:
+                        self.weight[term].extend(weights[start:start + length])
+                    start += length
+
+            if tables['positions'] is not None:
+                pindex = self.fpindex.setdefault(field, {})
+                for term, positions in zip(tables['terms'], tables['positions']):
+                    if term not in pindex:
+                        pindex[term] = positions
+                    else:
+                        pindex[term].extend(positions)
+
     def index_file(self, filename):
         """
         NECESARIO PARA TODAS LAS VERSIONES
@@ -162,8 +593,8 @@ class SAR_Project:
         Dependiendo del valor de "self.multifield" y "self.positional" se debe ampliar el indexado.
         En estos casos, se recomienda crear nuevos metodos para hacer mas sencilla la implementacion
 
-        input: "filename" es el nombre de un fichero en formato JSON Arrays (https://www.w3schools.com/js/js_json_arrays.asp).
-                Una vez parseado con json.load tendremos una lista de diccionarios, cada diccionario se corresponde a una noticia
+        input: "filename" es el nombre de un fichero en formato JSON Arrays (https://www.w3schools.com/js/js_json_arrays.asp)
+                o JSON Lines (extension .jsonl). Cada noticia es un diccionario, ver iter_news.
 
         """
 
@@ -171,20 +602,38 @@ class SAR_Project:
         new_id = len(self.news.keys())
         self.docs[doc_id] = filename
 
-        with open(filename) as fh:
-            jlist = json.load(fh)
-            for i, article in enumerate([new["article"] for new in jlist]):
-                self.news[new_id] = (doc_id, i)
-                for token in set(self.tokenize(article)):  # set() para eliminar repetidas
-                    if token not in self.index:
-                        self.index[token] = [new_id]
-                    else:
-                        self.index[token].append(new_id)
-                new_id += 1
+        # iter_news lee las noticias de una en una, sin cargar el fichero completo
+        for i, new in enumerate(iter_news(filename)):
+            self.news[new_id] = (doc_id, i)
+            self.store.append(zlib.compress(json.dumps({field: new.get(field) for field in self.STORED_FIELDS}).encode('utf-8')))
+            text = new.get("article") or ''
+            if self.positional:
+                # se guarda el texto y donde empieza cada token para construir los snippets sin volver a tokenizar
+                article, starts = self.tokenize_offsets(text)
+                self.articles.append(zlib.compress(text.encode('utf-8')))
+                # si lower() cambia la longitud del texto las posiciones no valen para el texto original
+                self.toffsets.append(encode_posting(starts) if len(text.lower()) == len(text) else b'')
+            else:
+                article = self.tokenize(text)
+            if self.multifield:
+                for field, tokenized in self.fields:
+                    value = new.get(field) or ''
+                    if field == 'article':
+                        self.index_tokens(new_id, article, field)
+                    elif tokenized:
+                        self.index_tokens(new_id, self.tokenize(value), field)
+                    elif value:
+                        # el campo entero es un unico termino
+                        self.index_tokens(new_id, [value.lower()], field)
+                if new.get('date'):
+                    self.add_date(new['date'].lower(), new_id, new_id + 1)
+            else:
+                self.index_tokens(new_id, article)
+            new_id += 1
         
         
         #
-        # "jlist" es una lista con tantos elementos como noticias hay en el fichero,
+        # cada elemento de "iter_news" es una noticia,
         # cada noticia es un diccionario con los campos:
         #      "title", "date", "keywords", "article", "summary"
         #
@@ -197,19 +646,146 @@ class SAR_Project:
         ### COMPLETAR ###
         #################
 
+    def index_tokens(self, new_id, tokens, field='article'):
+        """
+        Añade la noticia "new_id" a las posting lists de sus terminos en el indice del campo "field"
+        y, con self.positional, sus posiciones al indice posicional del campo (solo campos tokenizados).
+        En 'article' guarda tambien la frecuencia de cada termino (self.weight) y la longitud de la noticia
+        (self.lengths) para el ranking.
+
+        param:  "new_id": newid de la noticia
+                "tokens": lista de terminos de la noticia en el campo, en orden
+                "field": campo al que pertenecen los terminos
+
+        """
+        index = self.findex.get(field)
+        if index is None:
+            index = self.findex[field] = {}
+        weights = None
+        if field == 'article':
+            weights = self.weight
+            self.lengths.append(len(tokens))
+        pindex = None
+        if self.positional and self.is_tokenized(field):
+            pindex = self.fpindex.get(field)
+            if pindex is None:
+                pindex = self.fpindex[field] = {}
+        # una sola busqueda en cada diccionario por termino distinto de la noticia (get en lugar de in + [])
+        if pindex is not None:
+            # posiciones de cada termino en la noticia (su numero es la frecuencia del termino)
+            positions = {}
+            for pos, token in enumerate(tokens):
+                p = positions.get(token)
+                if p is None:
+                    positions[token] = [pos]
+                else:
+                    p.append(pos)
+            for token, p in positions.items():
+                pl = pindex.get(token)
+                if pl is None:
+                    pl = pindex[token] = PositionList()
+                pl.append(p)
+            counts = ((token, len(p)) for token, p in positions.items())
+        elif weights is not None:
+            counts = Counter(tokens).items()  # frecuencias contadas en C, sin recorrer los tokens en Python
+        else:
+            counts = ((token, 0) for token in set(tokens))  # set() para eliminar repetidas
+        for token, tf in counts:
+            posting = index.get(token)
+            if posting is None:
+                index[token] = PostingList((new_id,))
+            else:
+                posting.append(new_id)
+            if weights is not None:
+                w = weights.get(token)
+                if w is None:
+                    weights[token] = array('I', (tf,))
+                else:
+                    w.append(tf)
+
+    def add_date(self, date, start, end):
+        """
+        Añade al indice de fechas (self.dindex) las noticias start..end-1, todas con fecha "date".
+
+        Como las noticias se indexan por dias (un fichero por dia) las de una fecha tienen newids
+        consecutivos y cada fecha suele tener un unico intervalo.
+
+        """
+        runs = self.dindex.get(date)
+        if runs is None:
+            self.dindex[date] = array('I', [start, end])
+        elif runs[-1] == start:
+            runs[-1] = end
+        else:
+            runs.extend((start, end))
+
+    def is_tokenized(self, field):
+        """
+        return: True si el campo "field" se tokeniza al indexarlo (ver self.fields)
+
+        """
+        return dict(self.fields).get(field, True)
+
+    def vocabulary(self):
+        """
+        Diccionario de terminos compartido por todos los campos: los terminos de todos los indices, ordenados.
+        El identificador de un termino (en el segmento, el indice de stems y el permuterm) es su posicion en esta lista.
+
+        return: lista ordenada de terminos
+
+        """
+        terms = set()
+        for index in self.findex.values():
+            terms.update(index)
+        return sorted(terms)
+
     def tokenize(self, text):
         """
         NECESARIO PARA TODAS LAS VERSIONES
 
         Tokeniza la cadena "texto" eliminando simbolos no alfanumericos y dividientola por espacios.
-        Puedes utilizar la expresion regular 'self.tokenizer'.
+
+        Los tokens son las secuencias de caracteres alfanumericos (self.word), que es lo mismo que sustituir
+        los no alfanumericos (self.tokenizer) por espacios y dividir, pero en una sola pasada y sin construir
+        la cadena intermedia (ver SAR_Benchmark.py tokenize).
 
         params: 'text': texto a tokenizar
 
         return: lista de tokens
 
         """
-        return self.tokenizer.sub(' ', text.lower()).split()
+        return self.word.findall(text.lower())
+
+    def tokenize_offsets(self, text):
+        """
+        Tokeniza "text" como self.tokenize y devuelve tambien la posicion (caracter) en la que empieza cada token.
+
+        param:  'text': texto a tokenizar
+
+        return: lista de tokens y array con el caracter en el que empieza cada uno
+
+        """
+        tokens = []
+        starts = array('I')
+        for match in self.word.finditer(text.lower()):
+            tokens.append(match.group())
+            starts.append(match.start())
+        return tokens, starts
+
+    def make_bitmaps(self):
+        """
+        Crea un Bitmap con la posting list de los terminos frecuentes de cada campo tokenizado (ver
+        BITMAP_RATIO). get_posting los devuelve en lugar de la posting list, de modo que AND, OR y NOT
+        entre terminos frecuentes son operaciones entre enteros en lugar de recorrer las listas.
+
+        """
+        n = len(self.news)
+        min_df = max(self.BITMAP_MIN_DF, n / self.BITMAP_RATIO)
+        self.fbitmaps = {}
+        for field, index in self.findex.items():
+            if self.is_tokenized(field):
+                self.fbitmaps[field] = {term: Bitmap.from_posting(posting, n)
+                                        for term, posting in index.items() if len(posting) >= min_df}
 
     def make_stemming(self):
         """
@@ -221,8 +797,12 @@ class SAR_Project:
 
         """
         
-        ## Por cada token del índice...
-        for token in self.index:
+        ## Por cada token de los campos tokenizados...
+        tokens = set()
+        for field, index in self.findex.items():
+            if self.is_tokenized(field):
+                tokens.update(index)
+        for token in sorted(tokens):
             
             ## Genero su stem.
             stemmedtoken = self.stemmer.stem(token)
@@ -236,8 +816,14 @@ class SAR_Project:
             else :
                 self.sindex[stemmedtoken].append(token)
         
+        ## Para los stems con varios terminos y muchas noticias guardo ya la union de sus posting lists,
+        ## asi get_stemming no tiene que mezclarlas en cada consulta.
+        for stem, tokens in self.sindex.items():
+            if len(tokens) > 1:
+                postings = [self.index.get(token, []) for token in tokens]
+                if sum(len(p) for p in postings) >= self.STEM_POSTING_MIN:
+                    self.spostings[stem] = merge_postings(postings)
 
-        
 
         ####################################################
         ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE STEMMING ##
@@ -250,27 +836,13 @@ class SAR_Project:
         Crea el indice permuterm (self.ptindex) para los terminos de todos los indices.
 
         """
-        # Por cada token en el índice, añadimos el símbolo '$' como delimitador
-        # Para cada longitud y rotación posible que contenga el símbolo '$',
-        # # se crea una entrada y se añade el token a la lista
-        for token in self.index.keys():
-            pterm = token + '$'
-            for i in range(len(pterm)):
-                #for j in range(0, len(pterm) - 1):
-                #print(i, j)
-                #print(len(self.ptindex))
-                    #item = pterm[j:]
-                if '$' in pterm:
-                    # Si ya existe en el índice permuterm, añadimos el token (si es nuevo) a su lista
-                    if pterm in self.ptindex.keys():
-                        if token not in self.ptindex.get(pterm):
-                            self.ptindex[pterm].append(token)
-                    # Y si no existía, se crea una entrada, con una lista de tokens
-                    else:
-                        self.ptindex[pterm] = [token]
-                # Siguiente rotación del token
-                pterm = pterm[1:] + pterm[0]
-
+        # Cada termino tiene un identificador: su posicion en el diccionario de terminos ordenado.
+        # Se generan todas las rotaciones de termino + '$' como pares (identificador, desplazamiento)
+        # y se ordenan de una vez (ver PermutermIndex.build)
+        t0 = time.time()
+        self.terms = self.vocabulary()
+        self.ptindex = PermutermIndex.build(self.terms)
+        self.permuterm_time = time.time() - t0
 
         ####################################################
         ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE STEMMING ##
@@ -285,16 +857,15 @@ class SAR_Project:
         """
         print("=" * 40)
         if self.multifield:
-            print("Number of indexed days: " + str(len(self.dates)))
+            print("Number of indexed days: " + str(len(self.findex.get('date', ()))))
+            print("\t# intervals of consecutive newids: %d" % (sum(len(runs) for runs in self.dindex.values()) // 2))
             print("-" * 40)
             print("Number of indexed news: " + str(len(self.news)))
             print("-" * 40)
             print("TOKENS:")
-            print("\t# tokens in 'title': " + str(len(self.title)))
-            print("\t# tokens in 'date': " + str(len(self.dates)))
-            print("\t# tokens in 'keywords': " + str(len(self.keywords)))
-            print("\t# tokens in 'article': " + str(len(self.article)))
-            print("\t# tokens in 'summary': " + str(len(self.summary)))
+            for field, tokenized in self.fields:
+                print("\t# tokens in '%s': %d" % (field, len(self.findex.get(field, ()))))
+            print("\t# terms in the shared dictionary: %d" % len(self.vocabulary()))
             print("-" * 40)
         else:
             #print("Number of indexed days: " + str(len(self.dates)))
@@ -305,20 +876,18 @@ class SAR_Project:
             print("-" * 40)
             #print("Positional queries are NOT allowed.")
             #print("-" * 40)
+        self.show_posting_stats()
+        stored = sum(len(record) for record in self.store)
+        print("STORED FIELDS: %.1f KB (%.1f bytes/news)" % (stored / 1024, stored / max(1, len(self.store))))
+        print("-" * 40)
 
         if self.permuterm:
-
-            if self.multifield:
-                print("PERMUTERMS: ")
-                print("\t# permuterms in 'title': " + str(len(self.pttitle)))
-                print("\t# permuterms in 'date': " + str(len(self.ptdates)))
-                print("\t# permuterms in 'keywords': " + str(len(self.ptkeywords)))
-                print("\t# permuterms in 'article': " + str(len(self.ptarticle)))
-                print("\t# permuterms in 'summary': " + str(len(self.ptsummary)))
-                print("-" * 40)
-            else:
-                print("PERMUTERMS: " + str(len(self.ptindex)))
-                print("-" * 40)
+            # un unico indice permuterm sobre el diccionario de terminos compartido por todos los campos
+            print("PERMUTERMS: " + str(len(self.ptindex)))
+            print("\tbuild time: %.2fs" % self.permuterm_time)
+            print("\tsize: %.1f KB (%.2f bytes/permuterm)" % (self.ptindex.nbytes() / 1024,
+                                                             self.ptindex.nbytes() / max(1, len(self.ptindex))))
+            print("-" * 40)
 
         if self.stemming == True:
             #if self.multifield == True:
@@ -331,6 +900,7 @@ class SAR_Project:
                 #print("-" * 40)
             #else:
                 print("STEMS: " + str(len(self.sindex)))
+                print("\t# stems with precomputed postings: " + str(len(self.spostings)))
                 print("-" * 40)
         
         print ("Parentheses queries are allowed")
@@ -338,6 +908,7 @@ class SAR_Project:
 
         if self.positional == True:
             print("Positional queries are allowed.")
+            self.show_positional_stats()
         else:
             print("Positional queries are NOT allowed.")
         print("=" * 40)
@@ -346,6 +917,199 @@ class SAR_Project:
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
         ########################################
 
+    def show_posting_stats(self):
+        """
+        Muestra el tamaño de las posting lists de todos los campos: bytes por posting en memoria
+        (array + cabecera de cada PostingList) y en disco (secciones "index.<campo>" del segmento).
+
+        """
+        postings = [p for index in self.findex.values() for p in index.values()]
+        npostings = sum(len(p) for p in postings)
+        if npostings == 0:
+            return
+        memory = sum(sys.getsizeof(p) for p in postings)
+        print("POSTINGS: " + str(npostings))
+        print("\tbytes/posting in memory: %.2f" % (memory / npostings))
+        disk = self.posting_disk_bytes()
+        if disk is not None:
+            print("\tbytes/posting on disk: %.2f" % (disk / npostings))
+        print("-" * 40)
+
+    def posting_disk_bytes(self):
+        """
+        return: bytes que ocupan en el segmento las posting lists de todos los campos (None si no se ha guardado)
+
+        """
+        if len(self.disk_bytes) == 0:
+            return None
+        return sum(self.disk_bytes.get('index.' + field, 0) for field in self.findex)
+
+    def show_positional_stats(self):
+        """
+        Compara el tamaño del indice posicional con el de las posting lists (en el segmento si se ha guardado).
+
+        """
+        npostings = sum(len(p) for field in self.fpindex for p in self.findex[field].values())
+        positions = [p for pindex in self.fpindex.values() for p in pindex.values()]
+        if len(self.disk_bytes) > 0:
+            positional = sum(size for name, size in self.disk_bytes.items() if name.startswith('pindex.'))
+        else:
+            positional = sum(p.nbytes() for p in positions)
+        npositions = sum(len(decode_posting(p.data)) for p in positions)
+        postings = self.posting_disk_bytes()
+        if postings is None:
+            postings = 4 * npostings
+        print("\t# positions: %d (%.2f per posting)" % (npositions, npositions / max(1, npostings)))
+        print("\tsize: %.1f KB (%.2f bytes/position), %.1fx the postings (%.1f KB)" % (
+            positional / 1024, positional / max(1, npositions), positional / max(1, postings),
+            postings / 1024))
+        offsets = sum(len(starts) for starts in self.toffsets)
+        articles = sum(len(article) for article in self.articles)
+        print("\tsnippets: %.1f KB of token offsets (%.2f bytes/token), %.1f KB of compressed articles" % (
+            offsets / 1024, offsets / max(1, sum(self.lengths)), articles / 1024))
+
+    def save(self, filename):
+        """
+        Guarda el indice en "filename" con el formato de segmento de SAR_segment: diccionario de terminos
+        ordenado comun a todos los campos + posting lists de cada campo + tablas de noticias y documentos.
+
+        Las posting lists de cada campo y los indices de stems y permuterm usan identificadores de termino
+        (posicion del termino en el diccionario ordenado) en lugar de cadenas.
+
+        """
+        terms = self.vocabulary()
+        term_id = {term: i for i, term in enumerate(terms)}
+        empty = PositionList()
+
+        writer = SegmentWriter(filename)
+        writer.set_config(multifield=self.multifield, positional=self.positional,
+                          stemming=self.stemming, permuterm=self.permuterm,
+                          field_sizes={field: len(index) for field, index in self.findex.items()})
+        writer.add_strings('terms', terms)
+        for field, index in self.findex.items():
+            writer.add_lists('index.' + field, (index.get(term, ()) for term in terms))
+            pindex = self.fpindex.get(field)
+            if self.positional and pindex is not None:
+                writer.add_lists('pindex.%s.offsets' % field, (pindex.get(term, empty).offsets for term in terms))
+                writer.add_blobs('pindex.%s.data' % field, (pindex.get(term, empty).data for term in terms))
+        for field, bitmaps in self.fbitmaps.items():
+            writer.add_dict('bitmaps.' + field, ((term, bitmaps[term].words()) for term in sorted(bitmaps)), 'uint32')
+        writer.add_dict('sindex', ((stem, sorted(term_id[t] for t in self.sindex[stem])) for stem in sorted(self.sindex)))
+        writer.add_dict('spostings', ((stem, self.spostings[stem]) for stem in sorted(self.spostings)))
+        if len(self.ptindex) > 0:
+            writer.add_table('ptindex', [self.ptindex.pairs], width=2)
+        writer.add_dict('dindex', ((date, self.dindex[date]) for date in sorted(self.dindex)))
+        writer.add_lists('weight', (self.weight.get(term, ()) for term in terms), 'varint')
+        writer.add_table('lengths', [self.lengths], width=1)
+        writer.add_blobs('store', self.store)
+        if self.positional:
+            writer.add_blobs('articles', self.articles)
+            writer.add_blobs('toffsets', self.toffsets)
+        writer.add_strings('docs', (self.docs[doc_id] for doc_id in range(len(self.docs))))
+        writer.add_table('news', (self.news[new_id] for new_id in range(len(self.news))), width=2)
+        writer.close()
+        self.disk_bytes = section_sizes(writer.header)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Abre un indice guardado con self.save_index. Si se ha actualizado con self.update_dir y tiene
+        varios segmentos o noticias borradas se abre como un SAR_MultiSegment.
+
+        return: objeto SAR_Project
+
+        """
+        manifest = read_manifest(filename)
+        if manifest is not None and (len(manifest['segments']) > 1 or len(manifest['deleted']) > 0):
+            project = SAR_MultiSegment(filename, manifest)
+        elif manifest is not None:
+            project = cls.open_segment(segment_path(filename, manifest['segments'][0]['file']))
+        else:
+            project = cls.open_segment(filename)
+        project.indexfile = filename
+        return project
+
+    @classmethod
+    def from_pickle(cls, filename):
+        """
+        Carga un indice guardado con pickle por una version anterior al formato de segmento.
+
+        El objeto guardado no tiene los atributos añadidos despues (cache, findex, ...), asi que se crea
+        un SAR_Project nuevo con su indice de 'article', sus documentos y sus noticias, y se rehacen los
+        indices de stems y permuterm si los tenia. Como no tiene frecuencias ni longitudes de las noticias,
+        el ranking usa tf = 1 y la misma longitud para todas.
+
+        return: objeto SAR_Project
+
+        """
+        with open(filename, 'rb') as fh:
+            old = pickle.load(fh)
+        project = cls()
+        project.multifield = project.positional = False
+        project.stemming = getattr(old, 'stemming', False)
+        project.permuterm = getattr(old, 'permuterm', False)
+        project.index = {term: PostingList(posting) for term, posting in old.index.items()}
+        project.findex = {'article': project.index}
+        project.docs = dict(old.docs)
+        project.news = dict(old.news)
+        project.weight = {term: array('I', [1]) * len(posting) for term, posting in project.index.items()}
+        project.lengths = array('I', [1]) * len(project.news)
+        project.finish_index()
+        return project
+
+    @classmethod
+    def open_segment(cls, filename):
+        """
+        Abre un indice guardado con self.save. Los datos no se leen al abrirlo: el fichero se proyecta
+        en memoria con mmap y cada posting list se lee cuando se consulta.
+
+        Por compatibilidad, si "filename" no es un segmento se carga con pickle (self.from_pickle).
+
+        return: objeto SAR_Project
+
+        """
+        if not is_segment(filename):
+            return cls.from_pickle(filename)
+
+        segment = Segment(filename)
+        project = cls()
+        project.disk_bytes = section_sizes(segment.header)
+        config = dict(segment.config)
+        field_sizes = config.pop('field_sizes')
+        for key, value in config.items():
+            setattr(project, key, value)
+
+        terms = SegmentTerms(segment, 'terms')
+        project.findex = {}
+        project.fpindex = {}
+        for field, size in field_sizes.items():
+            project.findex[field] = SegmentFieldIndex(terms, SegmentLists(segment, 'index.' + field), size)
+            if 'pindex.%s.offsets' % field in segment.sections:
+                project.fpindex[field] = SegmentPositions(segment, 'pindex.' + field, terms)
+        project.index = project.findex['article']
+        project.pindex = project.fpindex.get('article', {})
+        term = terms.key_at
+        project.sindex = SegmentDict(segment, 'sindex', lambda ids: [term(i) for i in ids])
+        project.spostings = SegmentDict(segment, 'spostings')
+        project.dindex = SegmentDict(segment, 'dindex')
+        project.weight = SegmentFieldIndex(terms, SegmentLists(segment, 'weight'), field_sizes['article'])
+        project.lengths = segment.part('lengths', 0, 'I')
+        project.store = SegmentBlobs(segment, 'store')
+        if 'toffsets' in segment.sections:
+            project.articles = SegmentBlobs(segment, 'articles')
+            project.toffsets = SegmentBlobs(segment, 'toffsets')
+        if 'ptindex' in segment.sections:
+            project.ptindex = PermutermIndex(term, segment.part('ptindex', 0, 'I'))
+        project.docs = SegmentStrings(segment, 'docs')
+        project.news = SegmentTable(segment, 'news')
+        nnews = len(project.news)
+        project.fbitmaps = {}
+        for field in field_sizes:
+            if 'bitmaps.' + field in segment.sections:
+                project.fbitmaps[field] = SegmentDict(segment, 'bitmaps.' + field,
+                                                      lambda words: Bitmap.from_words(words, nnews))
+        return project
+
     ###################################
     ###                             ###
     ###   PARTE 2.1: RECUPERACION   ###
@@ -359,6 +1123,9 @@ class SAR_Project:
         Resuelve una query.
         Debe realizar el parsing de consulta que sera mas o menos complicado en funcion de la ampliacion que se implementen
 
+        La consulta se convierte en un arbol (SAR_query.parse_query), se optimiza y se ordenan sus
+        operandos (self.plan_query) y despues se evalua (self.evaluate).
+
 
         param:  "query": cadena con la query
                 "prev": incluido por si se quiere hacer una version recursiva. No es necesario utilizarlo.
@@ -369,64 +1136,9 @@ class SAR_Project:
         """
 
         if query is None or len(query) == 0:
-            return []
+            return PostingList()
 
-        if "(" in query:
-            return self.solve_query_parenthesis(query)
-
-        if len(query) == 1:
-            if '?' in query:
-                return self.get_permuterm(query)
-            elif '*' in query:
-                return self.get_permuterm(query)
-            else:
-                return self.get_posting(query)
-
-        reg = re.compile(r"\w+")
-        tokens = reg.findall(query)
-        firstToken = tokens.pop(0)
-        # Si el primer elemento no es un token, sino un conector 'NOT'
-        if firstToken == 'NOT':
-            connector = firstToken
-            firstToken = tokens.pop(0)
-            if '?' in firstToken:
-                firstPosting = self.get_permuterm(firstToken)
-            elif '*' in firstToken:
-                firstPosting = self.get_permuterm(firstToken)
-            else:
-                firstPosting = self.get_posting(firstToken)
-            firstPosting = self.reverse_posting(firstPosting)
-        # Si el primer elemento es un token
-        else:
-            firstPosting = self.get_posting(firstToken)
-
-        while len(tokens) > 1:
-            connector = tokens.pop(0)
-            nextToken = tokens.pop(0)
-
-            # Si el siguiente elemento no es un token, sino un conector 'NOT'
-            if nextToken == 'NOT':
-                nextToken = tokens.pop(0)
-                if '?' in nextToken:
-                    nextPosting = self.get_permuterm(nextToken)
-                elif '*' in nextToken:
-                    nextPosting = self.get_permuterm(nextToken)
-                else:
-                    nextPosting = self.get_posting(nextToken)
-                nextPosting = self.reverse_posting(nextPosting)
-            # Si el siguiente elemento es un token
-            else:
-                nextPosting = self.get_posting(nextToken)
-
-            # Según el conector de la solicitud
-            if connector == 'AND':
-                firstPosting = self.and_posting(firstPosting, nextPosting)
-            if connector == 'OR':
-                firstPosting = self.or_posting(firstPosting, nextPosting)
-                
-        if firstPosting is None:
-            return []
-        return firstPosting
+        return self.evaluate(self.plan_query(query))
 
         ########################################
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
@@ -435,7 +1147,8 @@ class SAR_Project:
     def solve_query_parenthesis(self, query, prev={}):
         """
         Resuelve una query con parentesis.
-        Debe realizar el parsing de consulta que sera mas o menos complicado en funcion de la ampliacion que se implementen
+
+        El parser de self.solve_query ya admite parentesis anidados, se mantiene por compatibilidad.
 
 
         param:  "query": cadena con la query
@@ -445,56 +1158,344 @@ class SAR_Project:
         return: posting list con el resultado de la query
 
         """
-        tokenized = re.findall(r"(\(|\)|[\w|:]+)", query)
-
-        return self._solve_query_parenthesis(tokenized)
-
-    def _solve_query_parenthesis(self, query, ind=""):
-        value = []
-        conjunction = "OR"
-        negation = False
-        i = 0
-        while i < len(query):
-            token = query[i]
-            if token == "(":
-                n = 1
-                i += 1
-                n_query = []
-                while True:
-                    if query[i] == "(":
-                        n += 1
-                    elif query[i] == ")":
-                        if n == 1:
-                            break
-                        n -= 1
-                    n_query.append(query[i])
-                    i += 1
-                b = self._solve_query_parenthesis(n_query, ind+"    ")
-                value = self.operate(value, b, conjunction, negation)
-                negation = False
-            elif token == "NOT":
-                negation = True
-            elif token == "AND" or token == "OR":
-                conjunction = token
-                #print(ind, token)
-            else:
-                value = self.operate(value, self.solve_query(token), conjunction, negation)
-                negation = False
-            i += 1
+        return self.solve_query(query)
+
+    def plan_query(self, query):
+        """
+        Construye el plan de una consulta: el arbol de SAR_query.parse_query reescrito con SAR_query.optimize
+        (cadenas AND / OR n-arias, NOT convertidos en diferencias) y con los operandos de cada nodo
+        ordenados de menor a mayor numero de noticias.
+
+        Para estimar el tamaño de cada nodo se recuperan las posting lists de sus terminos, que se
+        guardan en el propio nodo y se reutilizan al evaluarlo.
+
+        param:  "query": cadena con la query
 
-        return value.copy()
+        return: nodo raiz del plan (SAR_query.QueryNode)
+
+        """
+        plan = optimize(parse_query(query, [field for field, tokenized in self.fields]))
+        self._estimate(plan)
+        return plan
+
+    def _estimate(self, node):
+        """
+        Rellena "estimate" en "node" y sus descendientes y ordena sus operandos.
+
+        Si el resultado del nodo esta en self.cache no se planifican sus descendientes.
+
+        """
+        if node.posting is not None:
+            # nodo compartido con otra consulta de self.solve_batch, ya planificado y evaluado
+            node.estimate = len(node.posting)
+            return
+        n = len(self.news)
+        t0 = time.perf_counter()
+        node.posting = self.cache.get((self.use_stemming, node.key()))
+        if node.posting is not None:
+            node.cached = True
+            node.elapsed = time.perf_counter() - t0
+            node.estimate = len(node.posting)
+        elif isinstance(node, (Term, Phrase, Range)):
+            node.posting = self.solve_leaf(node)
+            self.cache.put((self.use_stemming, node.key()), node.posting)
+            node.elapsed = time.perf_counter() - t0
+            node.estimate = len(node.posting)
+        elif isinstance(node, Not):
+            self._estimate(node.child)
+            node.estimate = n - node.child.estimate
+        elif isinstance(node, And):
+            for child in node.children:
+                self._estimate(child)
+            node.children.sort(key=lambda child: child.estimate)
+            node.estimate = node.children[0].estimate
+        elif isinstance(node, Or):
+            for child in node.children:
+                self._estimate(child)
+            node.children.sort(key=lambda child: child.estimate)
+            node.estimate = min(n, sum(child.estimate for child in node.children))
+        elif isinstance(node, Diff):
+            self._estimate(node.positive)
+            for child in node.negatives:
+                self._estimate(child)
+            node.negatives.sort(key=lambda child: child.estimate)
+            node.estimate = node.positive.estimate
+
+    def solve_leaf(self, node):
+        """
+        Recupera la posting list de un termino (con o sin comodines), de una secuencia de terminos o de un rango de fechas.
 
+        param:  "node": nodo SAR_query.Term, SAR_query.Phrase o SAR_query.Range
 
-    def operate(self, a, b, op, not_b):
-        if not_b:
-            b = self.reverse_posting(b)
-        if op == "AND":
-            return self.and_posting(a, b)
-        elif op == "OR":
-            return self.or_posting(a, b)
+        return: posting list
+
+        """
+        if isinstance(node, Range):
+            result = self.get_date_range(node.lo, node.hi, node.field)
+        elif isinstance(node, Phrase):
+            if len(node.terms) == 1:
+                result = self.findex.get(node.field, {}).get(node.terms[0])
+            elif node.slop:
+                result = self.get_proximity(node.terms, node.slop, node.field)
+            else:
+                result = self.get_positionals(node.terms, node.field)
+        elif node.is_wildcard():
+            result = self.get_permuterm(node.term, node.field)
         else:
-            print("ERROR")
+            result = self.get_posting(node.term, node.field)
+        if result is None:
+            return PostingList()
+        return result
+
+    def evaluate(self, node):
+        """
+        Evalua un plan de self.plan_query. Guarda en cada nodo el numero de noticias y el tiempo empleado.
+
+        - AND: intersecciones de la posting list mas corta a la mas larga, parando si el resultado queda vacio
+        - OR: uniones de la mas corta a la mas larga
+        - MINUS: diferencias sucesivas (minus_posting)
+        - NOT: complemento perezoso (reverse_posting)
+
+        El resultado de cada nodo se guarda en self.cache.
+
+        param:  "node": nodo del plan
+
+        return: posting list con el resultado
+
+        """
+        if node.posting is not None:
+            node.size = len(node.posting)
+            return node.posting
+
+        t0 = time.perf_counter()
+        if isinstance(node, (Term, Phrase, Range)):
+            result = self.solve_leaf(node)
+        elif isinstance(node, Not):
+            result = self.reverse_posting(self.evaluate(node.child))
+        elif isinstance(node, And):
+            result = self.evaluate(node.children[0])
+            for child in node.children[1:]:
+                if len(result) == 0:
+                    break
+                result = self.and_posting(result, self.evaluate(child))
+        elif isinstance(node, Or):
+            result = PostingList()
+            for child in node.children:
+                result = self.or_posting(result, self.evaluate(child))
+        elif isinstance(node, Diff):
+            result = self.evaluate(node.positive)
+            for child in node.negatives:
+                if len(result) == 0:
+                    break
+                result = self.minus_posting(result, self.evaluate(child))
+        node.elapsed = time.perf_counter() - t0
+        node.size = len(result)
+        node.posting = result
+        self.cache.put((self.use_stemming, node.key()), result)
+        return result
+
+    def solve_batch(self, queries, jobs=1):
+        """
+        Resuelve un lote de consultas compartiendo las subconsultas comunes.
+
+        Primero se construyen los planes de todas las consultas y cada subconsulta (con la misma clave
+        normalizada, SAR_query.QueryNode.key) se sustituye por un unico nodo compartido, de modo que se
+        evalua una sola vez aunque aparezca en varias consultas. El resultado de cada nodo se libera
+        despues de la ultima consulta que lo usa.
+
+        Con "jobs" > 1 las hojas (terminos, comodines, frases, rangos) de todo el lote se resuelven antes en
+        un pool de procesos, cada uno con el indice abierto de nuevo (solo si se ha cargado con self.load).
+
+        param:  "queries": lista de consultas
+                "jobs": numero de procesos para resolver las hojas
+
+        return: generador de pares (consulta, plan evaluado) en el orden de "queries"; el resultado de la
+                consulta esta en plan.posting hasta que se pide el siguiente par. Si una consulta no es valida,
+                en lugar del plan va su SAR_query.QuerySyntaxError (el resto del lote se resuelve igual)
+
+        """
+        fields = [field for field, tokenized in self.fields]
+        nodes = {}  # clave --> nodo compartido
+        uses = {}  # clave --> numero de consultas pendientes que usan el nodo
+        plans = []
+        for query in queries:
+            try:
+                plan = self._share(optimize(parse_query(query, fields)), nodes)
+            except QuerySyntaxError as e:
+                plans.append(e)
+                continue
+            plans.append(plan)
+            for key in self._node_keys(plan):
+                uses[key] = uses.get(key, 0) + 1
+
+        if jobs > 1 and self.indexfile is not None:
+            leaves = []
+            for key, node in nodes.items():
+                if isinstance(node, (Term, Phrase, Range)):
+                    node.posting = self.cache.get((self.use_stemming, key))
+                    if node.posting is None:
+                        leaves.append(node)
+            self._solve_leaves_parallel(leaves, jobs)
+
+        for query, plan in zip(queries, plans):
+            if isinstance(plan, QuerySyntaxError):
+                yield query, plan
+                continue
+            self._estimate(plan)
+            self.evaluate(plan)
+            yield query, plan
+            for key in self._node_keys(plan):
+                uses[key] -= 1
+                if uses[key] == 0:
+                    nodes.pop(key).posting = None
+
+    def _share(self, node, nodes):
+        """
+        Sustituye "node" y sus descendientes por los nodos de "nodes" con la misma clave, añadiendo los que faltan.
+
+        return: nodo compartido equivalente a "node"
+
+        """
+        if isinstance(node, Not):
+            node.child = self._share(node.child, nodes)
+        elif isinstance(node, (And, Or)):
+            node.children = [self._share(child, nodes) for child in node.children]
+        elif isinstance(node, Diff):
+            node.positive = self._share(node.positive, nodes)
+            node.negatives = [self._share(child, nodes) for child in node.negatives]
+        return nodes.setdefault(node.key(), node)
+
+    def _node_keys(self, plan):
+        """
+        return: conjunto de claves de los nodos de un plan
+
+        """
+        keys = set()
+        pending = [plan]
+        while pending:
+            node = pending.pop()
+            key = node.key()
+            if key not in keys:
+                keys.add(key)
+                pending.extend(node.operands())
+        return keys
+
+    def _solve_leaves_parallel(self, leaves, jobs):
+        """
+        Resuelve las hojas "leaves" repartidas entre "jobs" procesos y guarda su resultado en cada nodo y en la cache.
+
+        """
+        chunks = [leaves[i::jobs] for i in range(jobs) if i < len(leaves)]
+        if len(chunks) == 0:
+            return
+        with ProcessPoolExecutor(len(chunks), initializer=_init_batch_worker,
+                                 initargs=(self.indexfile, self.use_stemming)) as pool:
+            for chunk, postings in zip(chunks, pool.map(_solve_leaves, chunks)):
+                for node, posting in zip(chunk, postings):
+                    node.posting = posting
+                    self.cache.put((self.use_stemming, node.key()), posting)
+
+    def iter_node(self, node):
+        """
+        Evaluacion perezosa de un plan de self.plan_query: genera los newid del resultado en orden sin
+        construir las posting lists intermedias, de modo que se puede parar en cuanto hay suficientes.
+
+        - AND: se recorre el operando mas corto y se comprueba cada newid en los demas (self.member)
+        - OR: mezcla k-way de los operandos
+        - MINUS: se recorre el positivo y se descartan los newid de los negativos
+        - NOT: newids que no genera el operando
+
+        Los nodos cuyo resultado ya se conoce (terminos, que se recuperan al planificar, o subconsultas
+        en cache) se recorren directamente.
+
+        param:  "node": nodo del plan
+
+        return: generador de newids ordenados
+
+        """
+        if node.posting is not None:
+            return iter(node.posting)
+        if isinstance(node, (Term, Phrase, Range)):
+            return iter(self.solve_leaf(node))
+        if isinstance(node, Not):
+            return self._iter_not(node.child)
+        if isinstance(node, And):
+            members = [self.member(child) for child in node.children[1:]]
+            return (newid for newid in self.iter_node(node.children[0]) if all(member(newid) for member in members))
+        if isinstance(node, Or):
+            return (newid for newid, _ in groupby(heapq.merge(*[self.iter_node(child) for child in node.children])))
+        if isinstance(node, Diff):
+            members = [self.member(child) for child in node.negatives]
+            return (newid for newid in self.iter_node(node.positive) if not any(member(newid) for member in members))
+
+    def _iter_not(self, node):
+        """
+        Genera los newid que no estan en el resultado de "node" (NOT perezoso).
+
+        """
+        prev = 0
+        for newid in self.iter_node(node):
+            yield from range(prev, newid)
+            prev = newid + 1
+        yield from range(prev, len(self.news))
+
+    def member(self, node):
+        """
+        Devuelve una funcion que indica si un newid esta en el resultado de "node", para newids crecientes:
+        con la posting list del nodo se busca con gallop desde la ultima posicion y si no se conoce se
+        avanza por self.iter_node(node).
+
+        param:  "node": nodo del plan
+
+        return: funcion newid --> True o False
+
+        """
+        p = node.posting
+        if isinstance(p, (Complement, Bitmap, Intervals)):
+            return p.__contains__
+        if p is not None:
+            cursor = [0]
+
+            def contains(newid):
+                cursor[0] = gallop(p, newid, cursor[0])
+                return cursor[0] < len(p) and p[cursor[0]] == newid
+            return contains
+
+        it = self.iter_node(node)
+        head = [next(it, None)]
+
+        def contains(newid):
+            while head[0] is not None and head[0] < newid:
+                head[0] = next(it, None)
+            return head[0] == newid
+        return contains
+
+    def show_plan(self, node, depth=0):
+        """
+        Muestra un plan evaluado: cada nodo con su numero de noticias y su tiempo.
 
+        param:  "node": nodo del plan
+                "depth": nivel de indentacion
+
+        """
+        if depth == 0:
+            print('Plan:')
+        size = '-' if node.size is None else str(node.size)
+        print('%-40s %8s news %10.3f ms%s' % ('    ' * (depth + 1) + node.label(), size, node.elapsed * 1000,
+                                              ' (cached)' if node.cached else ''))
+        if not node.cached:
+            for child in node.operands():
+                self.show_plan(child, depth + 1)
+
+    def show_cache_stats(self):
+        """
+        Muestra los aciertos y fallos de la cache de posting lists y subconsultas.
+
+        """
+        lookups = self.cache.hits + self.cache.misses
+        print("Cache: %d hits, %d misses (%.1f%% hits), %d entries, %.1f KB" % (
+            self.cache.hits, self.cache.misses, 100 * self.cache.hits / lookups if lookups else 0,
+            len(self.cache.entries), self.cache.bytes / 1024))
 
     def get_posting(self, term, field='article'):
         """
@@ -515,12 +1516,15 @@ class SAR_Project:
         """
         
         #### STEMMING ####
-        if self.use_stemming:
-            return self.get_stemming(term)
+        if self.use_stemming and self.is_tokenized(field):
+            return self.get_stemming(term, field)
         ####        ####
         
-        
-        return self.index.get(term, [])
+        # los terminos frecuentes tienen su posting list tambien como Bitmap (self.make_bitmaps)
+        bitmap = self.fbitmaps.get(field, {}).get(term)
+        if bitmap is not None:
+            return bitmap
+        return self.findex.get(field, {}).get(term, [])
 
         ########################################
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
@@ -537,13 +1541,101 @@ class SAR_Project:
 
         return: posting list
 
+        Primero se intersectan las posting lists de los terminos (como un AND); solo para las noticias
+        resultantes se decodifican las posiciones de cada termino (ver self.match_positions).
+
         """
-        pass
+        return self.get_proximity(terms, 0, field)
 
         ########################################################
         ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE POSICIONALES ##
         ########################################################
 
+    def get_proximity(self, terms, slop, field='article'):
+        """
+        Devuelve la posting list de las noticias en las que aparecen "terms" en orden y con como mucho
+        "slop" terminos entre cada uno y el siguiente (slop = 0 es una secuencia de terminos consecutivos).
+
+        param:  "terms": lista de terminos
+                "slop": numero maximo de terminos entre dos terminos consecutivos de "terms"
+                "field": campo sobre el que se debe recuperar la posting list
+
+        return: posting list
+
+        """
+        index = self.findex.get(field, {})
+        pindex = self.fpindex.get(field)
+        postings = [index.get(term, []) for term in terms]
+        if not self.positional or pindex is None or min(len(p) for p in postings) == 0:
+            return PostingList()
+        positions = [pindex[term] for term in terms]
+
+        candidates = postings[0]
+        for p in sorted(postings[1:], key=len):
+            candidates = self.and_posting(candidates, p)
+
+        r = PostingList()
+        cursors = [0] * len(terms)
+        for newid in candidates:
+            news_positions = []
+            for j in range(len(terms)):
+                cursors[j] = gallop(postings[j], newid, cursors[j])
+                news_positions.append(positions[j].positions_at(cursors[j]))
+            if self.match_positions(news_positions, slop):
+                r.append(newid)
+        return r
+
+    def match_positions(self, positions, slop):
+        """
+        Comprueba si hay una ocurrencia de los terminos en orden con como mucho "slop" terminos entre
+        cada uno y el siguiente.
+
+        param:  "positions": lista con las posiciones (ordenadas) de cada termino en la noticia
+                "slop": numero maximo de terminos intermedios
+
+        return: True o False
+
+        """
+        # posiciones del termino j-esimo en las que puede terminar una ocurrencia de los j primeros terminos
+        ends = positions[0]
+        for current in positions[1:]:
+            reachable = PostingList()
+            i = 0
+            for pos in current:
+                # hay algun final anterior en [pos - 1 - slop, pos - 1]?
+                i = gallop(ends, pos - 1 - slop, i)
+                if i < len(ends) and ends[i] < pos:
+                    reachable.append(pos)
+            if len(reachable) == 0:
+                return False
+            ends = reachable
+        return True
+
+    def get_date_range(self, lo, hi, field='date'):
+        """
+        Devuelve la posting list de las noticias con fecha entre "lo" y "hi" (ver SAR_query.Range).
+
+        Se buscan los extremos en las fechas ordenadas de self.dindex (dos busquedas binarias) y se
+        juntan sus intervalos de newids en un Intervals, sin generar los newids: un filtro de un año
+        son unos cientos de intervalos, y and_posting / minus_posting lo combinan por sus extremos.
+
+        param:  "lo", "hi": extremos del rango, None si el rango es abierto
+                "field": campo del rango, solo 'date' tiene indice de rangos
+
+        return: posting list (Intervals)
+
+        """
+        if field != 'date' or len(self.dindex) == 0:
+            return PostingList()
+        i, j = self.dindex.key_range(lo, hi)
+        runs = []
+        for k in range(i, j):
+            r = self.dindex.value_at(k)
+            runs.extend(zip(r[::2], r[1::2]))
+        # cada noticia tiene una unica fecha, los intervalos no se solapan
+        runs.sort()
+        return Intervals(runs, len(self.news))
+
     def get_stemming(self, term, field='article'):
         """
         NECESARIO PARA LA AMPLIACION DE STEMMING
@@ -558,7 +1650,14 @@ class SAR_Project:
         """
         
         # Generamos el stem del termino.
-        stem = self.stemmer.stem(term)
+        stem = self.stem(term)
+
+        # Si la posting list del stem se calculo al indexar (make_stemming, solo 'article') la devolvemos directamente.
+        if field == 'article':
+            r = self.spostings.get(stem)
+            if r is not None:
+                return r
+
         # Consultamos la lista de terminos pertenecientes a dicho stem.
         tokens = self.sindex.get(stem)
         
@@ -566,30 +1665,25 @@ class SAR_Project:
         if tokens == None:
             return []
         
-        r = aux = pl = []
-        
-        # Recorremos la lista de terminos.
-        for token in tokens:
-            
-            # Obtenemos la posting list de cada termino con el mismo stem y las concatenamos
-            pl = self.index.get(token)
-            aux = self.or_posting(r, pl)
-            r = aux
-            
-        # Eliminamos newid repetidos con la siguiente instrucción, al convertir a dict quitamos repetidos y
-        # lo volvemos a convertir a lista
-        #r = set(listapostings)
-            
-        # Ordenamos la lista
-        r.sort()
-            
-        return r
+        # Mezclamos de una pasada las posting lists de todos los terminos con el mismo stem
+        index = self.findex.get(field, {})
+        return merge_postings([index.get(token, []) for token in tokens])
                
 
         ####################################################
         ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE STEMMING ##
         ####################################################
 
+    def stem(self, term):
+        """
+        Devuelve el stem de "term" guardandolo en self.stems para no recalcularlo en siguientes consultas.
+
+        """
+        stem = self.stems.get(term)
+        if stem is None:
+            stem = self.stems[term] = self.stemmer.stem(term)
+        return stem
+
     def get_permuterm(self, term, field='article'):
         """
         NECESARIO PARA LA AMPLIACION DE PERMUTERM
@@ -602,55 +1696,50 @@ class SAR_Project:
         return: posting list
 
         """
-        
-        term = term + '$'
-
-        # Si contiene '?' rotamos hasta dejar el comodín al final de la palabra
-        # Obtenemos la lista de palabras del diccionario de igual longitud, de las que obtendremos la unión de sus posting list
-        if '?' in term:
-            while term[-1] != '?':
-                term = term[1:] + term[0]
-            term = term[:-1]
-            token_list = self.ptindex.get(term)
-            
-            # Extraemos los tokens con la longitud de la consulta
-            for i in range(len(token_list)):
-                if len(token_list[i]) != len(term):
-                    del token_list[i]
-
-            if len(token_list) == 1:
-                return self.solve_query(token_list[0])
-
-        # Si contiene '?' rotamos hasta dejar el comodín al final de la palabra
-        # Obtenemos la lista de palabras del diccionario de igual longitud, de las que obtendremos la unión de sus posting list
-        if '*' in term:
-            while term[-1] != '*':
-                term = term[1:] + term[0]
-            term = term[:-1]
-            token_list = []
-            # Extraemos los tokens con la longitud mayor o igual a la consulta y que coincidan con su permuterm
-            # Añadimos los tokens a la lista
-            for clave in self.ptindex.keys():
-                if clave[0:len(term)] == term:
-                    for tk in self.ptindex.get(clave):
-                        if tk not in token_list:
-                            token_list.append(tk)
-
-        if len(token_list) == 1:
-            return self.solve_query(token_list[0])
-        
-        # Calculamos la consulta como union de tokens
-        query = ''
-        for i in range(len(token_list) - 1):
-            query = query + token_list[i] + 'OR'
-        query = query + token_list[len(token_list)]
 
-        return self.solve_query(query)
+        # La posting list es la union (mezcla k-way) de las de todos los terminos que encajan con el patron
+        index = self.findex.get(field, {})
+        postings = [index[token] for token in self.expand_wildcard(term, field)]
+        return merge_postings(postings)
 
         ##################################################
         ## COMPLETAR PARA FUNCIONALIDAD EXTRA PERMUTERM ##
         ##################################################
 
+    def expand_wildcard(self, term, field='article'):
+        """
+        Devuelve los terminos del diccionario que encajan con "term", que contiene comodines (* o ?).
+
+        Se rota "term" + '$' para dejar el ultimo comodin al final (X*Y --> Y$X*) y se buscan en el indice
+        permuterm las rotaciones que empiezan por Y$X con una busqueda binaria (prefix_range), sin recorrer
+        todo el indice. Si hay varios comodines o '?' los candidatos se filtran con una expresion regular.
+
+        Sin indice permuterm, y en los campos no tokenizados (sus claves estan ordenadas y son pocas),
+        se buscan en el diccionario del campo los terminos que empiezan por X.
+
+        param:  "term": termino con comodines
+                "field": campo en el que deben aparecer los terminos
+
+        return: lista de terminos del campo
+
+        """
+        first = min(i for i, c in enumerate(term) if c in '*?')
+        last = max(i for i, c in enumerate(term) if c in '*?')
+        pattern = re.compile(''.join('.*' if c == '*' else '.' if c == '?' else re.escape(c) for c in term))
+
+        index = self.findex.get(field, {})
+        if len(self.ptindex) > 0 and self.is_tokenized(field):
+            lo, hi = self.ptindex.prefix_range(term[last + 1:] + '$' + term[:first])
+            candidates = {self.ptindex.term_at(self.ptindex.term_id_at(i)) for i in range(lo, hi)}
+        elif hasattr(index, 'prefix_range'):
+            lo, hi = index.prefix_range(term[:first])
+            candidates = [index.key_at(i) for i in range(lo, hi)]
+        else:
+            candidates = index.keys()
+
+        # el permuterm y el diccionario de un segmento tienen los terminos de todos los campos
+        return sorted(token for token in candidates if pattern.fullmatch(token) and token in index)
+
     def reverse_posting(self, p):
         """
         NECESARIO PARA TODAS LAS VERSIONES
@@ -658,6 +1747,9 @@ class SAR_Project:
         Devuelve una posting list con todas las noticias excepto las contenidas en p.
         Util para resolver las queries con NOT.
 
+        El resultado es un Complement: no se construye la lista, and_posting / or_posting / minus_posting
+        lo combinan directamente y solo se recorre (en tiempo lineal) si hay que enumerar los newid.
+        El complemento de un Bitmap o unos Intervals es otro Bitmap o Intervals (ver self.complement).
 
         param:  "p": posting list
 
@@ -665,22 +1757,33 @@ class SAR_Project:
         return: posting list con todos los newid exceptos los contenidos en p
 
         """
-        r = []
-        n = list(self.news.keys())
-        
-        #if p is None:
-        # return n
-        
-        for new in n:
-            if new not in p:
-                r.append(new)
-
-        return r
+        if isinstance(p, Complement):
+            return p.posting
+        return self.complement(p, len(self.news))
 
         ########################################
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
         ########################################
 
+    def complement(self, p, n):
+        """
+        Complemento de una posting list entre los newid 0..n-1: Complement perezoso o, si es un Bitmap
+        o unos Intervals, su inverso (asi un Complement nunca contiene un Bitmap ni unos Intervals).
+
+        """
+        if isinstance(p, (Bitmap, Intervals)):
+            return p.invert()
+        return Complement(p, n)
+
+    def to_bitmap(self, p, n):
+        """
+        return: la posting list "p" como Bitmap con n noticias
+
+        """
+        if isinstance(p, Bitmap):
+            return p
+        return Bitmap.from_posting(p, n)
+
     def and_posting(self, p1, p2):
         """
         NECESARIO PARA TODAS LAS VERSIONES
@@ -705,9 +1808,57 @@ class SAR_Project:
             sino
                 p2 ← Avanzar_Siguiente(p2)
 
+        Si una posting list es mucho mas larga que la otra (GALLOP_RATIO) se recorre la corta y se busca
+        cada newid en la larga con busqueda exponencial (gallop), con coste O(corta * log(larga)).
+
+        Con complementos (NOT): A AND NOT B = A - B y NOT A AND NOT B = NOT (A OR B).
+
+        Con Intervals (rangos de fechas): se cortan por sus extremos, con una busqueda binaria por intervalo
+        en la otra posting list.
+
+        Con Bitmap (terminos frecuentes): entre dos Bitmap es el AND de sus bits; con una posting list
+        se recorre la lista y se consulta cada newid en el Bitmap.
+
         """
 
-        r = []
+        if isinstance(p1, Complement) and isinstance(p2, Complement):
+            return self.complement(self.or_posting(p1.posting, p2.posting), p1.n)
+        if isinstance(p2, Complement):
+            return self.minus_posting(p1, p2.posting)
+        if isinstance(p1, Complement):
+            return self.minus_posting(p2, p1.posting)
+
+        if isinstance(p1, Intervals):
+            p1, p2 = p2, p1
+        if isinstance(p2, Intervals):
+            if isinstance(p1, Intervals):
+                return p1.intersect(p2)
+            if isinstance(p1, Bitmap):
+                return Bitmap(p1.bits & p2.mask(), p1.n)
+            return p2.select(p1)
+
+        if isinstance(p1, Bitmap) and isinstance(p2, Bitmap):
+            return Bitmap(p1.bits & p2.bits, p1.n)
+        if isinstance(p1, Bitmap):
+            p1, p2 = p2, p1
+        if isinstance(p2, Bitmap):
+            return PostingList(newid for newid in p1 if newid in p2)
+
+        if len(p1) > len(p2):
+            p1, p2 = p2, p1
+        if len(p1) * self.GALLOP_RATIO < len(p2):
+            r = PostingList()
+            j = 0
+            for newid in p1:
+                j = gallop(p2, newid, j)
+                if j == len(p2):
+                    break
+                if p2[j] == newid:
+                    r.append(newid)
+                    j = j + 1
+            return r
+
+        r = PostingList()
         i = j = 0
         while i < len(p1) and j < len(p2):
             if p1[i] == p2[j]:
@@ -760,9 +1911,37 @@ class SAR_Project:
             hacer Añadir (respuesta, docID (p2))
             p2 ← Avanzar_Siguiente(p2)
 
+        Con complementos (NOT): A OR NOT B = NOT (B - A) y NOT A OR NOT B = NOT (A AND B).
+
+        Con Intervals (rangos de fechas) el resultado son Intervals (cada newid de la otra posting list es
+        un intervalo de uno), o un Bitmap si la otra es un Bitmap.
+
+        Con Bitmap (terminos frecuentes) el resultado es el OR de los bits, pasando antes a Bitmap la
+        otra posting list si no lo es.
+
         """
 
-        r = []
+        if isinstance(p1, Complement) and isinstance(p2, Complement):
+            return self.complement(self.and_posting(p1.posting, p2.posting), p1.n)
+        if isinstance(p2, Complement):
+            return self.complement(self.minus_posting(p2.posting, p1), p2.n)
+        if isinstance(p1, Complement):
+            return self.complement(self.minus_posting(p1.posting, p2), p1.n)
+
+        if isinstance(p1, Intervals):
+            p1, p2 = p2, p1
+        if isinstance(p2, Intervals):
+            if isinstance(p1, Bitmap):
+                return Bitmap(p1.bits | p2.mask(), p1.n)
+            if not isinstance(p1, Intervals):
+                p1 = Intervals(((newid, newid + 1) for newid in p1), p2.n)
+            return p1.union(p2)
+
+        if isinstance(p1, Bitmap) or isinstance(p2, Bitmap):
+            n = p1.n if isinstance(p1, Bitmap) else p2.n
+            return Bitmap(self.to_bitmap(p1, n).bits | self.to_bitmap(p2, n).bits, n)
+
+        r = PostingList()
         i = j = 0
         while i < len(p1) and j < len(p2):
             if (p1[i] == p2[j]):
@@ -802,9 +1981,64 @@ class SAR_Project:
 
         return: posting list con los newid incluidos de p1 y no en p2
 
+        Recorre ambas listas a la vez como and_posting, guardando los newid de p1 que no estan en p2.
+        Si p2 es mucho mas larga que p1 se busca cada newid de p1 en p2 con gallop.
+
+        Con Intervals (rangos de fechas): se cortan por sus extremos, como en and_posting.
+
+        Con Bitmap (terminos frecuentes): si p1 es un Bitmap, AND de sus bits con los bits invertidos de p2;
+        si solo p2 lo es, se recorre p1 y se consulta cada newid en p2.
+
         """
 
-        pass
+        if isinstance(p1, Complement) and isinstance(p2, Complement):
+            return self.minus_posting(p2.posting, p1.posting)
+        if isinstance(p2, Complement):
+            return self.and_posting(p1, p2.posting)
+        if isinstance(p1, Complement):
+            return self.complement(self.or_posting(p1.posting, p2), p1.n)
+
+        if isinstance(p1, Intervals):
+            if isinstance(p2, Intervals):
+                return p1.intersect(p2.invert())
+            if isinstance(p2, Bitmap):
+                return Bitmap(p1.mask() & ~p2.bits, p2.n)
+            return p1.remove(p2)
+        if isinstance(p2, Intervals):
+            if isinstance(p1, Bitmap):
+                return Bitmap(p1.bits & ~p2.mask(), p1.n)
+            return p2.invert().select(p1)
+
+        if isinstance(p1, Bitmap):
+            return Bitmap(p1.bits & ~self.to_bitmap(p2, p1.n).bits, p1.n)
+        if isinstance(p2, Bitmap):
+            return PostingList(newid for newid in p1 if newid not in p2)
+
+        r = PostingList()
+        if len(p1) * self.GALLOP_RATIO < len(p2):
+            j = 0
+            for newid in p1:
+                j = gallop(p2, newid, j)
+                if j == len(p2) or p2[j] != newid:
+                    r.append(newid)
+            return r
+
+        i = j = 0
+        while i < len(p1) and j < len(p2):
+            if p1[i] == p2[j]:
+                i = i + 1
+                j = j + 1
+            elif p1[i] < p2[j]:
+                r.append(p1[i])
+                i = i + 1
+            else:
+                j = j + 1
+
+        while i < len(p1):  # Bucle que vacia la p1
+            r.append(p1[i])
+            i = i + 1
+
+        return r
 
         ########################################################
         ## COMPLETAR PARA TODAS LAS VERSIONES SI ES NECESARIO ##
@@ -816,22 +2050,27 @@ class SAR_Project:
     ###                               ###
     #####################################
 
-    def solve_and_count(self, query):
+    def solve_and_count(self, query, plan=None):
         """
         NECESARIO PARA TODAS LAS VERSIONES
 
         Resuelve una consulta y la muestra junto al numero de resultados 
 
         param:  "query": query que se debe resolver.
+                "plan": plan de la consulta si ya se ha construido (p.e. con self.solve_batch)
 
         return: el numero de noticias recuperadas, para la opcion -T
 
         """
-        result = self.solve_query(query)
+        if plan is None:
+            plan = self.plan_query(query)
+        result = self.evaluate(plan)
         print("%s\t%d" % (query, len(result)))
+        if self.show_explain:
+            self.show_plan(plan)
         return len(result)  # para verificar los resultados (op: -T)
 
-    def solve_and_show(self, query):
+    def solve_and_show(self, query, plan=None):
         """
         NECESARIO PARA TODAS LAS VERSIONES
 
@@ -841,36 +2080,235 @@ class SAR_Project:
 
         - En funcion del valor de "self.show_snippet" se mostrara una informacion u otra.
         - Si se implementa la opcion de ranking y en funcion del valor de self.use_ranking debera llamar a self.rank_result        
+        - Con self.page solo se muestra esa pagina; sin ranking la consulta se evalua de forma perezosa (self.iter_node)
 
         param:  "query": query que se debe resolver.
+                "plan": plan de la consulta si ya se ha construido (p.e. con self.solve_batch)
 
-        return: el numero de noticias recuperadas, para la opcion -T
+        return: el numero de noticias recuperadas, para la opcion -T (con self.page y sin ranking, las generadas hasta completar la pagina)
         
         """
-        result = self.solve_query(query)
-        if self.use_ranking:
-            result = self.rank_result(result, query)
+        if plan is None:
+            plan = self.plan_query(query)
+        shown, nresults, exact, start = self.select_results(plan, query)
 
         print('========================================')
         print('Query: '+str(query)+'\n')
-        print('Number of results: '+str(len(result))+'\n')
-        i=0
+        if self.show_explain:
+            self.show_plan(plan)
+            print()
+        print('Number of results: '+(str(nresults) if exact else 'at least %d' % nresults)+'\n')
+        if self.page is not None and not self.show_all:
+            print('Page %d: results %d-%d\n' % (self.page, start + 1, start + len(shown)))
+        i=start
+        files = {}  # ficheros ya leidos en esta consulta, solo si la noticia no esta en self.store
+        snippet_terms = self.snippet_terms(query) if self.show_snippet else []
         
-        for noticia in result:
+        for noticia, score in shown:
             i=1+i
-            fileId   = self.news[noticia]
-            with open(self.docs[fileId[0]]) as f:
-                jsonNoticia = json.load(f)            
-            jsonNoticia=jsonNoticia[fileId[1]]
-            print('#%s  (0) (%s) (%s) %s: (%s)  \n'%(i,noticia,jsonNoticia['date'],jsonNoticia['title'],jsonNoticia['keywords']))
+            jsonNoticia = self.get_news(noticia, files)
+            print('#%s  (%s) (%s) (%s) %s: (%s)  \n'%(i,round(score, 3),noticia,jsonNoticia['date'],jsonNoticia['title'],jsonNoticia['keywords']))
             if(self.show_snippet):
-                print('Summary: %s \n'%(jsonNoticia['summary']))
+                snippet = self.make_snippet(noticia, snippet_terms)
+                if snippet is not None:
+                    print('Snippet: %s \n'%(snippet))
+                else:
+                    print('Summary: %s \n'%(jsonNoticia['summary']))
         print('========================================')
-        return len(result)
+        return nresults
         ########################################
         ## COMPLETAR PARA TODAS LAS VERSIONES ##
         ########################################
 
+    def select_results(self, plan, query):
+        """
+        Evalua un plan y selecciona las noticias a mostrar, con su puntuacion: las SHOW_MAX primeras
+        (todas con self.show_all) o las de la pagina self.page, ordenadas por self.rank con self.use_ranking.
+
+        param:  "plan": plan de la consulta (self.plan_query)
+                "query": consulta
+
+        return: noticias a mostrar como pares (newid, puntuacion), numero de resultados, si ese numero es exacto
+                (con self.page y sin ranking puede ser solo una cota inferior) y posicion de la primera noticia
+
+        """
+        start = 0
+        if self.page is None or self.show_all:
+            result = self.evaluate(plan)
+            nresults = len(result)
+            exact = True
+            if self.use_ranking:
+                shown = self.rank(result, query)
+            else:
+                shown = ((noticia, 0) for noticia in (result if self.show_all else islice(result, self.SHOW_MAX)))
+        else:
+            start = (self.page - 1) * self.page_size
+            end = start + self.page_size
+            if self.use_ranking:
+                result = self.evaluate(plan)
+                nresults = len(result)
+                exact = True
+                shown = self.rank(result, query, end)[start:]
+            else:
+                # sin ranking la evaluacion es perezosa y se detiene al completar la pagina,
+                # si quedan mas noticias solo se sabe que hay al menos end + 1
+                shown = []
+                count = 0
+                for count, noticia in enumerate(self.iter_node(plan), 1):
+                    if count > end:
+                        break
+                    if count > start:
+                        shown.append((noticia, 0))
+                nresults = count
+                exact = count <= end
+        return shown, nresults, exact, start
+
+    def get_news(self, newid, files=None):
+        """
+        Devuelve los campos de una noticia para mostrarla. Se leen del almacen de documentos (self.store),
+        sin abrir el fichero JSON de la noticia.
+
+        Si la noticia no esta en el almacen se lee su fichero completo y se guarda en "files", de modo que
+        cada fichero se lee una sola vez aunque tenga varios resultados.
+
+        param:  "newid": newid de la noticia
+                "files": diccionario doc_id --> lista de noticias del fichero, compartido por los resultados de una consulta
+
+        return: diccionario con los campos de la noticia
+
+        """
+        if newid < len(self.store):
+            return json.loads(zlib.decompress(self.store[newid]))
+        doc_id, pos = self.news[newid]
+        if files is None:
+            files = {}
+        if doc_id not in files:
+            files[doc_id] = list(iter_news(self.docs[doc_id]))
+        return files[doc_id][pos]
+
+    def snippet_terms(self, query):
+        """
+        Prepara los terminos y frases de 'article' de "query" para self.make_snippet, una vez por consulta:
+        cada termino (expandido como en self.query_terms) y cada frase con la posting list y el PositionList
+        de sus terminos, de modo que para cada noticia solo se buscan y decodifican sus posiciones.
+
+        Las frases se resaltan solo donde aparecen completas (como las resuelve self.get_proximity), sin
+        separar sus terminos.
+
+        param:  "query": consulta
+
+        return: lista de tuplas (clave, [(posting list, PositionList) de cada termino], slop)
+
+        """
+        if not self.positional:
+            return []
+        entries = {}
+        for node in self.query_leaves(query):
+            if isinstance(node, Phrase) and len(node.terms) > 1:
+                if all(term in self.index for term in node.terms):
+                    entries[str(node)] = ([(self.index[term], self.pindex[term]) for term in node.terms], node.slop)
+            else:
+                for term in self.leaf_terms(node):
+                    if term not in entries and term in self.index:
+                        entries[term] = ([(self.index[term], self.pindex[term])], 0)
+        return [(key, words, slop) for key, (words, slop) in sorted(entries.items())]
+
+    def phrase_spans(self, positions, slop):
+        """
+        Ocurrencias de los terminos en orden con como mucho "slop" terminos entre cada uno y el siguiente
+        (como self.match_positions, pero devolviendo donde empieza y termina cada una).
+
+        param:  "positions": lista con las posiciones (ordenadas) de cada termino en la noticia
+                "slop": numero maximo de terminos intermedios
+
+        return: lista de pares (posicion del primer termino, posicion del ultimo)
+
+        """
+        # posiciones del termino j-esimo en las que termina una ocurrencia de los j primeros terminos
+        # y, para cada una, la posicion en la que empieza la ocurrencia mas corta
+        ends = begins = positions[0]
+        for current in positions[1:]:
+            reachable, reachable_begins = PostingList(), PostingList()
+            i = 0
+            for pos in current:
+                # el ultimo final anterior a pos esta en [pos - 1 - slop, pos - 1]?
+                i = gallop(ends, pos, i)
+                if i > 0 and ends[i - 1] >= pos - 1 - slop:
+                    reachable.append(pos)
+                    reachable_begins.append(begins[i - 1])
+            ends, begins = reachable, reachable_begins
+        return list(zip(begins, ends))
+
+    def make_snippet(self, newid, snippet):
+        """
+        Snippet KWIC de una noticia: la ventana de SNIPPET_TOKENS terminos de 'article' con mas terminos
+        y frases distintos de la consulta (y mas apariciones), con cada aparicion entre corchetes.
+
+        Las posiciones de los terminos se leen del indice posicional y el caracter en el que empieza cada
+        token de self.toffsets (calculados al indexar), asi que no hace falta volver a tokenizar el articulo.
+
+        param:  "newid": newid de la noticia
+                "snippet": terminos y frases a resaltar (ver self.snippet_terms)
+
+        return: cadena con el snippet o None si no hay indice posicional o la noticia no tiene ningun termino
+
+        """
+        if newid >= len(self.toffsets) or len(self.toffsets[newid]) == 0:
+            return None
+        hits = []  # (primera posicion, ultima posicion, clave) de cada aparicion
+        for key, words, slop in snippet:
+            positions = []
+            for posting, plist in words:
+                i = gallop(posting, newid)
+                if i == len(posting) or posting[i] != newid:
+                    break
+                positions.append(plist.positions_at(i))
+            else:
+                if len(positions) == 1:
+                    hits.extend((pos, pos, key) for pos in positions[0])
+                else:
+                    hits.extend((first, last, key) for first, last in self.phrase_spans(positions, slop))
+        if len(hits) == 0:
+            return None
+        hits.sort()
+
+        # ventana que empieza en una aparicion y tiene mas terminos distintos y, despues, mas apariciones
+        width = self.SNIPPET_TOKENS
+        counts = {}
+        best = (0, 0)
+        best_lo = j = 0
+        for lo in range(len(hits)):
+            while j < len(hits) and hits[j][1] < hits[lo][0] + width:
+                counts[hits[j][2]] = counts.get(hits[j][2], 0) + 1
+                j += 1
+            if (len(counts), j - lo) > best:
+                best, best_lo = (len(counts), j - lo), lo
+            counts[hits[lo][2]] -= 1
+            if counts[hits[lo][2]] == 0:
+                del counts[hits[lo][2]]
+        starts = decode_posting(self.toffsets[newid])
+        first = max(0, min(hits[best_lo][0] - width // 4, len(starts) - width))
+        last = min(len(starts), first + width) - 1
+
+        article = zlib.decompress(self.articles[newid]).decode('utf-8')
+
+        def token_end(pos):
+            match = self.word.match(article, starts[pos])
+            return match.end() if match else starts[pos]
+
+        pieces = []
+        prev = starts[first]
+        free = first  # primera posicion que no esta ya resaltada
+        for lo, hi, key in hits:
+            if free <= lo and hi <= last:
+                pieces.append(article[prev:starts[lo]])
+                pieces.append('[' + article[starts[lo]:token_end(hi)] + ']')
+                prev = token_end(hi)
+                free = hi + 1
+        pieces.append(article[prev:token_end(last)])
+        snippet = ' '.join(''.join(pieces).split())
+        return ('...' if first > 0 else '') + snippet + ('...' if last < len(starts) - 1 else '')
+
     def rank_result(self, result, query):
         """
         NECESARIO PARA LA AMPLIACION DE RANKING
@@ -885,7 +2323,565 @@ class SAR_Project:
 
         """
 
-        pass
+        return [newid for newid, score in self.rank(result, query, len(result))]
         ###################################################
         ## COMPLETAR PARA FUNCIONALIDAD EXTRA DE RANKING ##
         ###################################################
+
+
+    def rank(self, result, query, k=None):
+        """
+        Puntua con BM25 las noticias de "result" segun los terminos de "query" (ver self.query_terms)
+        y devuelve las "k" mejores.
+
+        Las noticias se recorren por orden de newid con un cursor por termino (document-at-a-time) y las
+        k mejores se guardan en un heap. Poda MaxScore: los terminos se ordenan por su puntuacion maxima y,
+        en cuanto la suma de las maximas de los primeros es menor que la peor puntuacion del heap, esos
+        terminos dejan de recorrerse (una noticia que solo tiene esos terminos no puede entrar) y solo se
+        buscan (gallop) en las noticias que tienen alguno de los demas. Asi no se puntuan todas las noticias.
+
+        param:  "result": posting list con el resultado de la consulta
+                "query": consulta
+                "k": numero de noticias a devolver, por defecto SHOW_MAX (todas si self.show_all)
+
+        return: lista de pares (newid, puntuacion) de mayor a menor puntuacion, a igual puntuacion por newid
+
+        """
+        if k is None:
+            k = len(result) if self.show_all else self.SHOW_MAX
+        if k == 0:
+            return []
+        n, avgdl = self.collection_stats()
+        k1, b = self.BM25_K1, self.BM25_B
+
+        # (puntuacion maxima, idf, posting list, frecuencias) de cada termino. La frecuencia normalizada
+        # tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl)) es como mucho la de la mayor tf con dl = 0
+        terms = []
+        for term in self.query_terms(query):
+            weights = self.term_weights(term)
+            if weights is None:
+                continue
+            posting, tfs = weights
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            maxtf = max(tfs)
+            terms.append((idf * (k1 + 1) * maxtf / (maxtf + k1 * (1 - b)), idf, posting, tfs))
+        terms.sort(key=lambda t: t[0])
+        cum = []  # cum[i]: suma de las puntuaciones maximas de terms[0..i]
+        for ub, idf, posting, tfs in terms:
+            cum.append(ub + (cum[-1] if cum else 0))
+
+        heap = []  # las k mejores como (puntuacion, -newid): en heap[0] la peor
+        first = 0  # terms[first:] son los terminos esenciales, terms[:first] los que se podan
+        cursors = [0] * len(terms)
+        rc = 0
+        while first < len(terms):
+            # siguiente noticia con algun termino esencial
+            newid = None
+            for i in range(first, len(terms)):
+                posting = terms[i][2]
+                if cursors[i] < len(posting) and (newid is None or posting[cursors[i]] < newid):
+                    newid = posting[cursors[i]]
+            if newid is None:
+                break
+            if isinstance(result, (Complement, Bitmap, Intervals)):
+                member = newid in result
+            else:
+                rc = gallop(result, newid, rc)
+                member = rc < len(result) and result[rc] == newid
+            norm = k1 * (1 - b + b * self.lengths[newid] / avgdl)
+            score = 0.0
+            for i in range(first, len(terms)):
+                ub, idf, posting, tfs = terms[i]
+                c = cursors[i]
+                if c < len(posting) and posting[c] == newid:
+                    if member:
+                        score += idf * tfs[c] * (k1 + 1) / (tfs[c] + norm)
+                    cursors[i] = c + 1
+            if not member:
+                continue
+            # terminos no esenciales, de mayor a menor puntuacion maxima, mientras la noticia pueda entrar
+            for i in range(first - 1, -1, -1):
+                if len(heap) == k and score + cum[i] < heap[0][0]:
+                    break
+                ub, idf, posting, tfs = terms[i]
+                c = cursors[i] = gallop(posting, newid, cursors[i])
+                if c < len(posting) and posting[c] == newid:
+                    score += idf * tfs[c] * (k1 + 1) / (tfs[c] + norm)
+            entry = (score, -newid)
+            if len(heap) < k:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+            else:
+                continue
+            if len(heap) == k:
+                while first < len(terms) and cum[first] < heap[0][0]:
+                    first += 1
+
+        ranked = [(-neg, score) for score, neg in sorted(heap, reverse=True)]
+        if len(ranked) < k:
+            # no se ha podado nada: el resto de noticias no tiene ningun termino, puntuan 0
+            scored = {newid for newid, score in ranked}
+            for newid in result:
+                if len(ranked) == k:
+                    break
+                if newid not in scored:
+                    ranked.append((newid, 0))
+        return ranked
+
+    def collection_stats(self):
+        """
+        Estadisticas de la coleccion para BM25 (self.rank). La longitud media se calcula en la primera consulta.
+
+        return: numero de noticias y longitud media de 'article'
+
+        """
+        if self.avgdl is None:
+            self.avgdl = sum(self.lengths) / max(1, len(self.lengths))
+        return len(self.news), self.avgdl
+
+    def term_weights(self, term):
+        """
+        Posting list de 'article' de "term" y la frecuencia del termino en cada noticia, para BM25 (self.rank).
+
+        return: par (posting list, frecuencias) o None si el termino no aparece
+
+        """
+        posting = self.index.get(term)
+        if not posting:
+            return None
+        return posting, self.weight[term]
+
+    def query_terms(self, query):
+        """
+        Terminos de 'article' que puntuan en el ranking y se resaltan en los snippets: los de los operandos no negados de la consulta,
+        separando las frases en sus terminos y expandiendo los comodines (y con self.use_stemming los stems)
+        a los terminos del indice.
+
+        param:  "query": consulta
+
+        return: lista ordenada de terminos
+
+        """
+        terms = set()
+        for node in self.query_leaves(query):
+            terms.update(self.leaf_terms(node))
+        return sorted(terms)
+
+    def query_leaves(self, query):
+        """
+        Hojas Term y Phrase de 'article' de los operandos no negados de "query".
+
+        """
+        nodes = [optimize(parse_query(query, [field for field, tokenized in self.fields]))]
+        while nodes:
+            node = nodes.pop()
+            if isinstance(node, (And, Or)):
+                nodes.extend(node.children)
+            elif isinstance(node, Diff):
+                nodes.append(node.positive)
+            elif isinstance(node, (Term, Phrase)) and node.field == 'article':
+                yield node
+
+    def leaf_terms(self, node):
+        """
+        Terminos del indice de una hoja de self.query_leaves: los de la frase o el termino, expandiendo
+        los comodines y, con self.use_stemming, los stems.
+
+        """
+        terms = set()
+        for word in (node.terms if isinstance(node, Phrase) else [node.term]):
+            if isinstance(node, Term) and node.is_wildcard():
+                terms.update(self.expand_wildcard(word))
+            elif self.use_stemming:
+                terms.update(self.sindex.get(self.stem(word)) or [word])
+            else:
+                terms.add(word)
+        return terms
+
+
+class SAR_MultiSegment(SAR_Project):
+    """
+    Indice con varios segmentos (ver SAR_Project.update_dir), abierto con SAR_Project.load.
+
+    Cada segmento es un SAR_Project con newids locales; los del segmento s empiezan en el newid global
+    new_bases[s]. Las hojas de las consultas se resuelven en cada segmento y sus resultados se concatenan
+    desplazados (los newids de un segmento son todos mayores que los de los anteriores) quitando las
+    noticias borradas; los operadores AND, OR y NOT trabajan ya sobre newids globales.
+
+    """
+
+    def __init__(self, indexfile, manifest):
+        super().__init__()
+        for key, value in manifest['config'].items():
+            setattr(self, key, value)
+        self.segments = [SAR_Project.open_segment(segment_path(indexfile, segment['file']))
+                         for segment in manifest['segments']]
+        self.doc_bases = [0]
+        self.new_bases = [0]
+        for segment in manifest['segments']:
+            self.doc_bases.append(self.doc_bases[-1] + segment['docs'])
+            self.new_bases.append(self.new_bases[-1] + segment['news'])
+        deleted = manifest['deleted']
+        self.deleted = merge_postings([range(start, end) for start, end in sorted(zip(deleted[::2], deleted[1::2]))])
+        self.deleted_set = set(self.deleted)
+
+        self.docs = SegmentConcat([seg.docs for seg in self.segments])
+        self.news = SegmentConcat([seg.news for seg in self.segments],
+                                  lambda s, news: (news[0] + self.doc_bases[s], news[1]))
+        self.store = SegmentConcat([seg.store for seg in self.segments])
+        self.lengths = array('I')
+        for seg in self.segments:
+            self.lengths.extend(seg.lengths)
+
+        def postings(values):
+            p = PostingList()
+            for s, posting in values:
+                p.extend(newid + self.new_bases[s] for newid in posting)
+            return p
+
+        def tfs(values):
+            return array('I', [tf for s, weights in values for tf in weights])
+
+        self.index = SegmentUnion([seg.index for seg in self.segments], postings)
+        self.weight = SegmentUnion([seg.weight for seg in self.segments], tfs)
+        self.sindex = SegmentUnion([seg.sindex for seg in self.segments],
+                                   lambda values: sorted({term for s, terms in values for term in terms}))
+
+    def set_stemming(self, v):
+        super().set_stemming(v)
+        for seg in self.segments:
+            seg.set_stemming(v)
+
+    def solve_leaf(self, node):
+        """
+        Resuelve la hoja en cada segmento y concatena los resultados, sin las noticias borradas.
+
+        """
+        results = [seg.solve_leaf(node) for seg in self.segments]
+        if any(isinstance(p, Intervals) for p in results) and all(isinstance(p, Intervals) or len(p) == 0
+                                                                 for p in results):
+            # rango de fechas: los intervalos de cada segmento desplazados (un segmento sin fechas da [])
+            runs = []
+            for s, p in enumerate(results):
+                if isinstance(p, Intervals):
+                    base = self.new_bases[s]
+                    runs.extend((start + base, end + base) for start, end in p.runs())
+            result = Intervals(runs, len(self.news))
+        elif any(isinstance(p, Bitmap) for p in results):
+            # termino frecuente en algun segmento: Bitmap global con los bits de cada segmento desplazados
+            bits = 0
+            for s, p in enumerate(results):
+                bits |= self.to_bitmap(p, len(self.segments[s].news)).bits << self.new_bases[s]
+            result = Bitmap(bits, len(self.news))
+        else:
+            result = PostingList()
+            for s, p in enumerate(results):
+                base = self.new_bases[s]
+                result.extend(newid + base for newid in p)
+        if len(self.deleted) > 0:
+            result = self.minus_posting(result, self.deleted)
+        return result
+
+    def reverse_posting(self, p):
+        # el complemento no incluye las noticias borradas
+        if isinstance(p, Complement):
+            return self.minus_posting(p.posting, self.deleted)
+        return self.complement(self.or_posting(p, self.deleted), len(self.news))
+
+    def _iter_not(self, node):
+        return (newid for newid in super()._iter_not(node) if newid not in self.deleted_set)
+
+    def expand_wildcard(self, term, field='article'):
+        return sorted(set().union(*[seg.expand_wildcard(term, field) for seg in self.segments]))
+
+    def collection_stats(self):
+        # las noticias borradas no cuentan en N ni en la longitud media
+        if self.avgdl is None:
+            total = sum(self.lengths) - sum(self.lengths[newid] for newid in self.deleted)
+            self.avgdl = total / max(1, len(self.lengths) - len(self.deleted))
+        return len(self.news) - len(self.deleted), self.avgdl
+
+    def term_weights(self, term):
+        # sin las noticias borradas, que no cuentan en la df
+        weights = super().term_weights(term)
+        if weights is None or len(self.deleted) == 0:
+            return weights
+        posting, tfs = weights
+        keep = [i for i, newid in enumerate(posting) if newid not in self.deleted_set]
+        if len(keep) == 0:
+            return None
+        return PostingList(posting[i] for i in keep), array('I', [tfs[i] for i in keep])
+
+    def snippet_terms(self, query):
+        # los de cada segmento, con sus posting lists locales
+        return [seg.snippet_terms(query) for seg in self.segments]
+
+    def make_snippet(self, newid, snippet):
+        s, i = self.store.locate(newid)
+        return self.segments[s].make_snippet(i, snippet[s])
+
+    def show_stats(self):
+        """
+        Muestra el numero de segmentos y de noticias y las estadisticas de cada segmento.
+
+        """
+        print("========================================")
+        print("Number of segments: %d" % len(self.segments))
+        print("Number of indexed news: %d (%d deleted)" % (len(self.news) - len(self.deleted), len(self.deleted)))
+        for s, seg in enumerate(self.segments):
+            print("Segment %d: newids %d-%d" % (s, self.new_bases[s], self.new_bases[s + 1] - 1))
+            seg.show_stats()
+
+
+def _index_files(task):
+    """
+    Tarea de cada proceso de SAR_Project.index_files_parallel.
+
+    param:  "task": tupla (lista de ficheros, configuracion del indice)
+
+    return: tablas de un SAR_Project con esos ficheros indexados, ver SAR_Project.export_partial
+
+    """
+    filenames, config = task
+    partial = SAR_Project()
+    for key, value in config.items():
+        setattr(partial, key, value)
+    for filename in filenames:
+        partial.index_file(filename)
+    return partial.export_partial()
+
+
+def news_files(root):
+    """
+    Ficheros de noticias de "root" (recursivamente) ordenados por ruta, para que la asignacion de doc_id
+    y new_id no dependa del sistema de ficheros ni del numero de procesos.
+
+    """
+    filenames = []
+    for dir, subdirs, files in os.walk(root):
+        subdirs.sort()
+        for filename in sorted(files):
+            if filename.endswith(NEWS_EXTENSIONS):
+                filenames.append(os.path.join(dir, filename))
+    return filenames
+
+
+def file_signature(filename):
+    """
+    return: diccionario con el mtime, el tamaño y el sha1 del contenido de "filename"
+
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            sha1.update(block)
+    stat = os.stat(filename)
+    return {'mtime': stat.st_mtime, 'size': stat.st_size, 'sha1': sha1.hexdigest()}
+
+
+# Manifiesto de un indice ("<indice>.manifest", JSON), para la indexacion incremental:
+#
+#   config:   configuracion del indice (multifield, positional, stemming, permuterm)
+#   segments: segmentos en orden de newid, cada uno con su fichero y su numero de documentos y noticias
+#   files:    ruta absoluta de cada fichero indexado --> firma (file_signature), primer newid y numero de noticias
+#   deleted:  intervalos [inicio, fin) de newids borrados (de ficheros modificados o borrados), como lista plana
+#   docs, news: numero total de documentos y noticias (el siguiente doc_id y newid)
+#   next:     numero del siguiente segmento ("<indice>.<next>")
+
+def new_manifest(config):
+    return {'config': config, 'segments': [], 'files': {}, 'deleted': [], 'docs': 0, 'news': 0, 'next': 1}
+
+
+def read_manifest(indexfile):
+    """
+    return: manifiesto del indice o None si no tiene
+
+    """
+    try:
+        with open(indexfile + '.manifest', encoding='utf-8') as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(indexfile, manifest):
+    """
+    Escribe el manifiesto en un fichero temporal y lo renombra, de modo que quien lo lea (SAR_Project.load)
+    ve el anterior o el nuevo, nunca uno a medias.
+
+    """
+    tmp = '%s.manifest.%d' % (indexfile, os.getpid())
+    with open(tmp, 'w', encoding='utf-8') as fh:
+        json.dump(manifest, fh)
+    os.replace(tmp, indexfile + '.manifest')
+
+
+@contextmanager
+def manifest_lock(indexfile, timeout=600):
+    """
+    Bloquea el manifiesto del indice (fichero "<indice>.lock") mientras se modifica, para que no
+    lo cambien a la vez una actualizacion y una fusion de segmentos.
+
+    """
+    lock = indexfile + '.lock'
+    t0 = time.time()
+    while True:
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if time.time() - t0 > timeout:
+                raise TimeoutError("'%s' is locked, remove it if no indexer is running" % lock)
+            time.sleep(0.05)
+    try:
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        yield
+    finally:
+        os.remove(lock)
+
+
+def segment_path(indexfile, name):
+    return os.path.join(os.path.dirname(indexfile), name)
+
+
+def remove_segment(indexfile, name):
+    if name != os.path.basename(indexfile):
+        try:
+            os.remove(segment_path(indexfile, name))
+        except FileNotFoundError:
+            pass
+
+
+def merge_start(segments, factor):
+    """
+    Politica de fusion de segmentos por tamaños: se fusionan los ultimos segmentos (los mas cortos posibles)
+    cuando son al menos "factor" y entre todos tienen al menos "factor" veces las noticias del mayor de ellos.
+
+    El segmento fusionado tiene al menos "factor" veces las noticias de cada uno de los fusionados, asi que
+    cada noticia se vuelve a escribir como mucho log_factor(n) veces. Al no agrupar por niveles enteros,
+    los segmentos de tamaños parecidos a ambos lados de una potencia de "factor" (p.e. 70 y 60 noticias)
+    tambien se fusionan y el numero de segmentos crece con log n (SAR_Benchmark.py merges lo comprueba).
+
+    param:  "segments": segmentos del manifiesto
+            "factor": SAR_Project.MERGE_FACTOR
+
+    return: posicion del primer segmento a fusionar (hasta el final) o None si no hay que fusionar
+
+    """
+    total = largest = 0
+    for start in range(len(segments) - 1, -1, -1):
+        news = max(1, segments[start]['news'])
+        total += news
+        largest = max(largest, news)
+        if len(segments) - start >= factor and total >= factor * largest:
+            return start
+    return None
+
+
+# indice abierto en cada proceso de SAR_Project._solve_leaves_parallel
+_batch_project = None
+
+
+def _init_batch_worker(indexfile, use_stemming):
+    global _batch_project
+    _batch_project = SAR_Project.load(indexfile)
+    _batch_project.set_stemming(use_stemming)
+
+
+def _solve_leaves(leaves):
+    """
+    Tarea de cada proceso de SAR_Project._solve_leaves_parallel.
+
+    return: PostingList (o Bitmap o Intervals) de cada hoja
+
+    """
+    return [_as_posting(_batch_project.solve_leaf(node)) for node in leaves]
+
+
+def _as_posting(p):
+    # los Bitmap e Intervals se envian tal cual, el resto como PostingList
+    return p if isinstance(p, (Bitmap, Intervals)) else PostingList(p)
+
+
+def iter_news(filename, chunk_size=1 << 16):
+    """
+    Lee las noticias de un fichero de una en una.
+
+    Los ficheros .jsonl tienen una noticia por linea. El resto se leen como un JSON Array de forma
+    incremental: se van leyendo bloques de "chunk_size" caracteres y se decodifica cada elemento en cuanto
+    esta completo, por lo que la memoria necesaria depende de la noticia mas grande y no del fichero.
+    Como json.load, lanza ValueError si el fichero no es un JSON Array valido (p.e. separadores de mas o
+    de menos entre elementos o datos despues del array).
+
+    param:  "filename": fichero de noticias
+            "chunk_size": tamaño minimo de cada lectura
+
+    return: generador de noticias (diccionarios)
+
+    """
+    with open(filename, encoding='utf-8') as fh:
+        if filename.endswith('.jsonl'):
+            for line in fh:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        decoder = json.JSONDecoder()
+        buf = fh.read(chunk_size)
+        eof = len(buf) == 0
+        pos = 0
+        # lo siguiente que se espera: 'open' el '[', 'first' el primer elemento o ']',
+        # 'element' un elemento (despues de una ',') y 'separator' una ',' o ']'
+        state = 'open'
+        while True:
+            # saltamos espacios hasta el siguiente simbolo
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos == len(buf):
+                if eof:
+                    raise ValueError("'%s': unexpected end of JSON array" % filename)
+                buf = fh.read(chunk_size)
+                eof = len(buf) == 0
+                pos = 0
+                continue
+            if state == 'open':
+                if buf[pos] != '[':
+                    raise ValueError("'%s' is not a JSON array" % filename)
+                state = 'first'
+                pos += 1
+                continue
+            if buf[pos] == ']' and state != 'element':
+                # despues del array solo puede haber espacios
+                rest = buf[pos + 1:]
+                while rest or not eof:
+                    if rest.strip():
+                        raise ValueError("'%s': extra data after the JSON array" % filename)
+                    rest = fh.read(chunk_size)
+                    eof = len(rest) == 0
+                return
+            if state == 'separator':
+                if buf[pos] != ',':
+                    raise ValueError("'%s': expected ',' or ']' between the elements of the JSON array" % filename)
+                state = 'element'
+                pos += 1
+                continue
+            if buf[pos] in ',]':
+                raise ValueError("'%s': missing element in JSON array" % filename)
+            try:
+                new, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                end = None
+            if end is None or (end == len(buf) and not eof):
+                # elemento incompleto: leemos mas (al menos lo que ya tenemos, para que el coste sea lineal)
+                if eof:
+                    raise ValueError("'%s': malformed JSON array" % filename)
+                more = fh.read(max(chunk_size, len(buf) - pos))
+                eof = len(more) == 0
+                buf = buf[pos:] + more
+                pos = 0
+                continue
+            yield new
+            pos = end
+            state = 'separator'
@@ -0,0 +1,682 @@
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from collections.abc import Mapping
+from heapq import merge
+from itertools import accumulate, groupby
+from operator import itemgetter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # opcional, solo para enumerar los newid de un Bitmap mas rapido
+
+
+class PostingList(array):
+    """
+    Posting list compacta: array de enteros sin signo ('I', 4 bytes por newid) ordenados de menor a mayor.
+
+    Se comporta como una secuencia (len, indexado, iteracion, append) por lo que
+    and_posting, or_posting y reverse_posting trabajan directamente sobre ella.
+    Al serializarse con pickle se guarda codificada por diferencias (gaps) + variable byte.
+
+    """
+
+    def __new__(cls, iterable=()):
+        return super().__new__(cls, 'I', iterable)
+
+    def __reduce_ex__(self, protocol):
+        return (decode_posting, (encode_posting(self),))
+
+    def __repr__(self):
+        return 'PostingList(%s)' % list(self)
+
+
+class Complement:
+    """
+    Complemento perezoso de una posting list: todos los newid de 0 a n-1 excepto los de "posting".
+
+    Lo devuelve reverse_posting para no construir una lista casi tan grande como la coleccion.
+    and_posting, or_posting y minus_posting lo combinan sin materializarlo (A AND NOT B es la
+    diferencia A - B, NOT A OR NOT B es NOT (A AND B), ...). Solo se recorre al iterar sobre el.
+
+    """
+
+    __slots__ = ('posting', 'n')
+
+    def __init__(self, posting, n):
+        self.posting = posting
+        self.n = n
+
+    def __len__(self):
+        return self.n - len(self.posting)
+
+    def __iter__(self):
+        prev = 0
+        for newid in self.posting:
+            yield from range(prev, newid)
+            prev = newid + 1
+        yield from range(prev, self.n)
+
+    def __contains__(self, newid):
+        i = bisect_left(self.posting, newid)
+        return 0 <= newid < self.n and (i == len(self.posting) or self.posting[i] != newid)
+
+    def materialize(self):
+        """
+        return: PostingList con los newid del complemento
+
+        """
+        r = PostingList()
+        prev = 0
+        for newid in self.posting:
+            r.extend(range(prev, newid))
+            prev = newid + 1
+        r.extend(range(prev, self.n))
+        return r
+
+    def __repr__(self):
+        return 'Complement(%r, %d)' % (self.posting, self.n)
+
+
+# posiciones de los bits a 1 de cada byte, para enumerar los newid de un Bitmap sin numpy
+_BYTE_BITS = [tuple(k for k in range(8) if byte >> k & 1) for byte in range(256)]
+
+
+class Bitmap:
+    """
+    Posting list densa como mapa de bits: el bit i del entero "bits" indica si el newid i esta en la lista,
+    para newids de 0 a n-1 (n noticias). Se usa para los terminos que aparecen en muchas noticias
+    (ver SAR_Project.make_bitmaps): ocupa n / 8 bytes y and_posting, or_posting, minus_posting y
+    reverse_posting entre dos Bitmap son operaciones de Python sobre enteros, que trabajan palabra a palabra.
+
+    Se comporta como un conjunto ordenado (len, in, iteracion en orden), pero no admite indexado.
+
+    """
+
+    __slots__ = ('bits', 'n', '_data')
+
+    def __init__(self, bits, n):
+        self.bits = bits
+        self.n = n
+        self._data = None  # bits como bytes (self.data), para consultar un newid sin desplazar el entero
+
+    @classmethod
+    def from_posting(cls, p, n):
+        """
+        return: Bitmap con los newid de la posting list "p"
+
+        """
+        data = bytearray((n + 7) // 8)
+        for newid in p:
+            data[newid >> 3] |= 1 << (newid & 7)
+        return cls(int.from_bytes(data, 'little'), n)
+
+    @classmethod
+    def from_words(cls, words, n):
+        """
+        return: Bitmap guardado como array de enteros de 32 bits (ver self.words)
+
+        """
+        if sys.byteorder == 'big':
+            words = array('I', words)
+            words.byteswap()
+        return cls(int.from_bytes(words.tobytes(), 'little'), n)
+
+    def words(self):
+        """
+        return: array de enteros de 32 bits con los bits (el primero con los newid 0..31), para guardarlo en un segmento
+
+        """
+        words = array('I')
+        words.frombytes(self.bits.to_bytes((self.n + 31) // 32 * 4, 'little'))
+        if sys.byteorder == 'big':
+            words.byteswap()
+        return words
+
+    def invert(self):
+        """
+        return: Bitmap con los newid de 0 a n-1 que no estan en este
+
+        """
+        return Bitmap(~self.bits & ((1 << self.n) - 1), self.n)
+
+    def data(self):
+        """
+        return: bits como bytes, el byte i con los newid 8i..8i+7 (el bit menos significativo el primero)
+
+        """
+        if self._data is None:
+            self._data = self.bits.to_bytes((self.n + 7) // 8, 'little')
+        return self._data
+
+    def __len__(self):
+        return self.bits.bit_count()
+
+    def __contains__(self, newid):
+        return 0 <= newid < self.n and (self.data()[newid >> 3] >> (newid & 7)) & 1 == 1
+
+    def __getstate__(self):
+        return self.bits, self.n
+
+    def __setstate__(self, state):
+        self.bits, self.n = state
+        self._data = None
+
+    def __iter__(self):
+        data = self.data()
+        if numpy is not None:
+            bits = numpy.unpackbits(numpy.frombuffer(data, dtype=numpy.uint8), bitorder='little')
+            yield from numpy.flatnonzero(bits).tolist()
+            return
+        for i, byte in enumerate(data):
+            if byte:
+                base = i << 3
+                for k in _BYTE_BITS[byte]:
+                    yield base + k
+
+    def materialize(self):
+        """
+        return: PostingList con los newid del Bitmap
+
+        """
+        return PostingList(self)
+
+    def nbytes(self):
+        return (self.n + 7) // 8
+
+    def __repr__(self):
+        return 'Bitmap(%s, %d)' % (list(self), self.n)
+
+
+class Intervals:
+    """
+    Posting list como intervalos de newids consecutivos [inicio, fin), ordenados y disjuntos, con newids
+    de 0 a n-1. La devuelve get_date_range: las noticias de una fecha tienen newids consecutivos, asi
+    que un rango de fechas son pocos intervalos aunque tenga muchas noticias.
+
+    and_posting, or_posting, minus_posting y reverse_posting la combinan por los extremos de sus
+    intervalos (select, remove, intersect, union, invert), sin recorrer sus newids.
+
+    """
+
+    __slots__ = ('starts', 'ends', 'n')
+
+    def __init__(self, runs, n):
+        """
+        param:  "runs": pares (inicio, fin) ordenados y disjuntos; se unen los contiguos y se quitan los vacios
+                "n": numero de noticias
+
+        """
+        self.starts = array('I')
+        self.ends = array('I')
+        self.n = n
+        for start, end in runs:
+            if start >= end:
+                continue
+            if len(self.ends) > 0 and self.ends[-1] == start:
+                self.ends[-1] = end
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def runs(self):
+        return zip(self.starts, self.ends)
+
+    def __len__(self):
+        return sum(self.ends) - sum(self.starts)
+
+    def __iter__(self):
+        for start, end in self.runs():
+            yield from range(start, end)
+
+    def __contains__(self, newid):
+        i = bisect_right(self.starts, newid) - 1
+        return i >= 0 and newid < self.ends[i]
+
+    def select(self, p):
+        """
+        return: PostingList con los newid de la posting list "p" que estan en los intervalos
+
+        """
+        r = PostingList()
+        lo = 0
+        for start, end in self.runs():
+            i = bisect_left(p, start, lo)
+            lo = bisect_left(p, end, i)
+            r.extend(p[i:lo])
+        return r
+
+    def remove(self, p):
+        """
+        return: Intervals sin los newid de la posting list "p" (cada uno parte su intervalo en dos)
+
+        """
+        runs = []
+        lo = 0
+        for start, end in self.runs():
+            i = bisect_left(p, start, lo)
+            lo = bisect_left(p, end, i)
+            for newid in p[i:lo]:
+                runs.append((start, newid))
+                start = newid + 1
+            runs.append((start, end))
+        return Intervals(runs, self.n)
+
+    def intersect(self, other):
+        """
+        return: Intervals con los newid que estan en este y en "other"
+
+        """
+        runs = []
+        i = j = 0
+        while i < len(self.starts) and j < len(other.starts):
+            start = max(self.starts[i], other.starts[j])
+            end = min(self.ends[i], other.ends[j])
+            runs.append((start, end))
+            if self.ends[i] < other.ends[j]:
+                i += 1
+            else:
+                j += 1
+        return Intervals(runs, self.n)
+
+    def union(self, other):
+        """
+        return: Intervals con los newid que estan en este o en "other"
+
+        """
+        runs = []
+        for start, end in merge(self.runs(), other.runs()):
+            if len(runs) > 0 and start <= runs[-1][1]:
+                runs[-1] = (runs[-1][0], max(runs[-1][1], end))
+            else:
+                runs.append((start, end))
+        return Intervals(runs, self.n)
+
+    def invert(self):
+        """
+        return: Intervals con los newid de 0 a n-1 que no estan en este
+
+        """
+        return Intervals(zip([0] + list(self.ends), list(self.starts) + [self.n]), self.n)
+
+    def mask(self):
+        """
+        return: entero con los bits de los newid de los intervalos (como Bitmap.bits)
+
+        """
+        bits = 0
+        for start, end in self.runs():
+            bits |= ((1 << (end - start)) - 1) << start
+        return bits
+
+    def materialize(self):
+        """
+        return: PostingList con los newid de los intervalos
+
+        """
+        return PostingList(self)
+
+    def nbytes(self):
+        return len(self.starts) * 8
+
+    def __repr__(self):
+        return 'Intervals(%s, %d)' % (list(self.runs()), self.n)
+
+
+class SortedTermDict(Mapping):
+    """
+    Diccionario de solo lectura con las claves ordenadas, version en memoria de SAR_segment.SegmentDict.
+
+    Las busquedas son binarias y prefix_range devuelve el rango de posiciones de las claves con un
+    prefijo dado en O(log n), sin recorrer el diccionario.
+
+    """
+
+    def __init__(self, items=()):
+        if isinstance(items, Mapping):
+            items = items.items()
+        pairs = sorted(items, key=itemgetter(0))
+        self._keys = [key for key, value in pairs]
+        self._values = [value for key, value in pairs]
+
+    def key_at(self, i):
+        return self._keys[i]
+
+    def value_at(self, i):
+        return self._values[i]
+
+    def find(self, key):
+        """
+        return: posicion de la clave o -1 si no esta
+
+        """
+        i = bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            return i
+        return -1
+
+    def prefix_range(self, prefix):
+        """
+        return: (lo, hi) tal que las claves de las posiciones lo..hi-1 son las que empiezan por "prefix"
+
+        """
+        lo = bisect_left(self._keys, prefix)
+        hi = bisect_left(self._keys, prefix + '\U0010ffff', lo)
+        return lo, hi
+
+    def key_range(self, lo, hi):
+        """
+        return: (i, j) tal que las claves de las posiciones i..j-1 son las que cumplen lo <= clave <= hi
+                o empiezan por "hi". Un extremo None no limita el rango.
+
+        """
+        i = 0 if lo is None else bisect_left(self._keys, lo)
+        j = len(self._keys) if hi is None else bisect_left(self._keys, hi + '\U0010ffff', i)
+        return i, j
+
+    def __getitem__(self, key):
+        i = self.find(key)
+        if i < 0:
+            raise KeyError(key)
+        return self._values[i]
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class PermutermIndex:
+    """
+    Indice permuterm compacto: en lugar de guardar cada rotacion como cadena, guarda pares
+    (identificador de termino, desplazamiento de la rotacion) en un array de enteros, ordenados
+    por la rotacion que representan. La rotacion se reconstruye a partir del termino cuando se
+    necesita (en las busquedas binarias de prefix_range), asi cada rotacion ocupa 8 bytes.
+
+    El identificador de termino es su posicion en el diccionario de terminos ordenado ("term_at").
+
+    """
+
+    def __init__(self, term_at, pairs):
+        """
+        param:  "term_at": funcion identificador de termino --> termino
+                "pairs": secuencia de enteros [tid0, k0, tid1, k1, ...] ordenada por rotacion
+
+        """
+        self.term_at = term_at
+        self.pairs = pairs
+
+    @classmethod
+    def build(cls, terms):
+        """
+        Construye el indice de todas las rotaciones de "terms" (lista ordenada de terminos).
+
+        Las rotaciones se generan como enteros y se reparten en cubos por su primer caracter;
+        cada cubo se ordena de una vez, de modo que las cadenas de las rotaciones solo existen
+        mientras se ordena su cubo.
+
+        """
+        buckets = {}
+        for tid, term in enumerate(terms):
+            pterm = term + '$'
+            for k, c in enumerate(pterm):
+                bucket = buckets.get(c)
+                if bucket is None:
+                    bucket = buckets[c] = []
+                bucket.append((tid << 32) | k)
+
+        def rotation(packed):
+            pterm = terms[packed >> 32] + '$'
+            k = packed & 0xFFFFFFFF
+            return pterm[k:] + pterm[:k]
+
+        pairs = array('I')
+        for c in sorted(buckets):
+            bucket = buckets.pop(c)
+            bucket.sort(key=rotation)
+            for packed in bucket:
+                pairs.append(packed >> 32)
+                pairs.append(packed & 0xFFFFFFFF)
+        return cls(terms.__getitem__, pairs)
+
+    def rotation(self, i):
+        pterm = self.term_at(self.pairs[2 * i]) + '$'
+        k = self.pairs[2 * i + 1]
+        return pterm[k:] + pterm[:k]
+
+    def term_id_at(self, i):
+        return self.pairs[2 * i]
+
+    def prefix_range(self, prefix):
+        """
+        return: (lo, hi) tal que las rotaciones de las posiciones lo..hi-1 son las que empiezan por "prefix"
+
+        """
+        positions = range(len(self))
+        lo = bisect_left(positions, prefix, key=self.rotation)
+        hi = bisect_left(positions, prefix + '\U0010ffff', lo, key=self.rotation)
+        return lo, hi
+
+    def nbytes(self):
+        return len(self.pairs) * 4
+
+    def __len__(self):
+        return len(self.pairs) // 2
+
+
+def merge_postings(postings):
+    """
+    Union de varias posting lists de una sola pasada (mezcla k-way con un heap), sin newid repetidos.
+
+    param:  "postings": lista de posting lists ordenadas
+
+    return: PostingList con la union
+
+    """
+    if len(postings) == 0:
+        return PostingList()
+    if len(postings) == 1:
+        return PostingList(postings[0])
+    return PostingList(newid for newid, _ in groupby(merge(*postings)))
+
+
+def posting_bytes(p):
+    """
+    Tamaño aproximado en memoria de una posting list (o de un Complement, un Bitmap o unos Intervals).
+
+    """
+    if isinstance(p, Complement):
+        p = p.posting
+    if isinstance(p, (Bitmap, Intervals)):
+        return 64 + p.nbytes()
+    return 64 + len(p) * 4
+
+
+class PostingCache:
+    """
+    Cache LRU de posting lists acotada por tamaño (bytes, segun posting_bytes).
+
+    Cuando se supera "max_bytes" se descartan las entradas usadas hace mas tiempo.
+    Cuenta los aciertos ("hits") y fallos ("misses") de get.
+
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        p = self.entries.get(key)
+        if p is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return p
+
+    def put(self, key, p):
+        size = posting_bytes(p)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.bytes -= posting_bytes(self.entries.pop(key))
+        self.entries[key] = p
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            old_key, old = self.entries.popitem(last=False)
+            self.bytes -= posting_bytes(old)
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+
+class PositionList:
+    """
+    Posiciones de un termino dentro de cada noticia de su posting list (en el mismo orden que la posting list).
+
+    Las posiciones de cada noticia se codifican con encode_posting (diferencias + variable byte) y se
+    concatenan en "data"; "offsets" indica donde empiezan las de cada noticia, de modo que se pueden
+    decodificar solo las de las noticias que interesan (positions_at).
+
+    """
+
+    __slots__ = ('offsets', 'data')
+
+    def __init__(self, offsets=None, data=None):
+        self.offsets = offsets if offsets is not None else array('I', [0])
+        self.data = data if data is not None else bytearray()
+
+    def append(self, positions):
+        """
+        Añade las posiciones (ordenadas) del termino en la siguiente noticia de su posting list.
+
+        """
+        self.data += encode_posting(positions)
+        self.offsets.append(len(self.data))
+
+    def extend(self, other):
+        """
+        Añade al final las posiciones de otro PositionList.
+
+        """
+        base = len(self.data)
+        self.data += other.data
+        self.offsets.extend(offset + base for offset in other.offsets[1:])
+
+    def positions_at(self, i):
+        """
+        return: PostingList con las posiciones del termino en la noticia i-esima de su posting list
+
+        """
+        return decode_posting(self.data[self.offsets[i]:self.offsets[i + 1]])
+
+    def nbytes(self):
+        return len(self.offsets) * 4 + len(self.data)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+def gallop(p, newid, lo=0):
+    """
+    Busqueda exponencial (galloping): avanza desde "lo" en saltos de 1, 2, 4, ... hasta pasar "newid"
+    y termina con una busqueda binaria en el ultimo salto. Cuesta O(log d), siendo d la distancia avanzada.
+
+    param:  "p": posting list ordenada
+            "newid": newid buscado
+            "lo": posicion desde la que buscar, todos los newid anteriores son menores que "newid"
+
+    return: primera posicion i >= lo con p[i] >= newid (len(p) si no hay ninguna)
+
+    """
+    n = len(p)
+    hi = lo
+    step = 1
+    while hi < n and p[hi] < newid:
+        lo = hi + 1
+        hi += step
+        step <<= 1
+    return bisect_left(p, newid, lo, min(hi, n))
+
+
+def encode_varint(values):
+    """
+    Codifica enteros no negativos en formato variable byte: 7 bits por byte, el bit alto indica que el numero continua.
+
+    param:  "values": iterable de enteros
+
+    return: bytes con los enteros codificados
+
+    """
+    out = bytearray()
+    for value in values:
+        while value >= 0x80:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+    return bytes(out)
+
+
+def decode_varint(data):
+    """
+    Decodifica el resultado de encode_varint.
+
+    param:  "data": bytes (o memoryview) codificados con encode_varint
+
+    return: PostingList con los enteros (sin ordenar)
+
+    """
+    data = bytes(data)
+    if data.isascii():
+        # todos los enteros son menores que 128 (un byte cada uno), el caso mas comun en las posting lists
+        return PostingList(array('B', data))
+    p = PostingList()
+    value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            p.append(value)
+            value = shift = 0
+    return p
+
+
+def encode_posting(p):
+    """
+    Codifica una posting list ordenada como diferencias entre newids consecutivos (gaps)
+    en formato variable byte (encode_varint).
+
+    param:  "p": posting list ordenada
+
+    return: bytes con la posting list codificada
+
+    """
+    prev = 0
+    gaps = []
+    for newid in p:
+        gaps.append(newid - prev)
+        prev = newid
+    return encode_varint(gaps)
+
+
+def decode_posting(data):
+    """
+    Decodifica el resultado de encode_posting.
+
+    param:  "data": bytes codificados con encode_posting
+
+    return: PostingList
+
+    """
+    return PostingList(accumulate(decode_varint(data)))
@@ -0,0 +1,170 @@
+import functools
+import os
+import time
+
+from SAR_postings import Complement, posting_bytes
+
+# Perfilado por etapas de SAR_Project (opcion --profile de SAR_Indexer.py y SAR_Searcher.py).
+#
+# Profiler.instrument sustituye en un objeto los metodos de cada etapa por envoltorios que miden su
+# tiempo y cuentan los elementos (tokens, newids de las posting lists, ...) y los bytes que tocan.
+# Los envoltorios se añaden al objeto solo si se activa el perfilado, asi que sin --profile no hay
+# ningun coste. Como las llamadas internas son self.metodo(...), tambien se miden las anidadas.
+#
+# Para cada etapa se acumula el tiempo total (incluyendo las etapas a las que llama) y el propio
+# (sin ellas). Las llamadas recursivas (evaluate, por ejemplo) solo se miden en la mas externa.
+
+
+def _posting_size(p):
+    if p is None:
+        return 0, 0
+    return len(p), posting_bytes(p)
+
+
+def _result(project, args, result):
+    # posting list devuelta por la etapa
+    return _posting_size(result)
+
+
+def _operands(project, args, result):
+    # posting lists que recorre la etapa
+    items = nbytes = 0
+    for p in args:
+        if p is not None and not isinstance(p, Complement):
+            n, b = _posting_size(p)
+            items += n
+            nbytes += b
+    return items, nbytes
+
+
+def _text(project, args, result):
+    # tokens generados y caracteres de texto leidos
+    tokens = result[0] if isinstance(result, tuple) else result
+    return len(tokens), len(args[0])
+
+
+def _news(project, args, result):
+    # noticia leida del almacen (comprimida)
+    newid = args[0]
+    return 1, len(project.store[newid]) if newid < len(project.store) else 0
+
+
+def _snippet(project, args, result):
+    newid = args[0]
+    if newid >= len(project.toffsets):
+        return 1, 0
+    return 1, len(project.articles[newid]) + len(project.toffsets[newid])
+
+
+def _file(project, args, result):
+    return 1, os.path.getsize(args[0])
+
+
+# etapas de las consultas: metodo --> funcion (objeto, argumentos, resultado) --> (elementos, bytes)
+QUERY_STAGES = {
+    'solve_and_show': None, 'solve_and_count': None, 'solve_query': None,
+    'plan_query': None, 'evaluate': _result, 'solve_leaf': _result,
+    'get_posting': _result, 'get_positionals': _result, 'get_proximity': _result, 'get_date_range': _result,
+    'get_stemming': _result, 'get_permuterm': _result, 'expand_wildcard': None,
+    'and_posting': _operands, 'or_posting': _operands, 'minus_posting': _operands, 'reverse_posting': _operands,
+    'rank': None, 'query_terms': None, 'snippet_terms': None, 'get_news': _news, 'make_snippet': _snippet,
+}
+
+# etapas de la indexacion
+INDEX_STAGES = {
+    'index_dir': None, 'index_files_parallel': None, 'merge_partial': None, 'index_file': _file,
+    'tokenize': _text, 'tokenize_offsets': _text, 'index_tokens': None, 'finish_index': None, 'make_bitmaps': None,
+    'make_stemming': None, 'make_permuterm': None, 'save': None, 'save_index': None, 'update_dir': None,
+}
+
+# percentiles de las latencias (SAR_Benchmark.py y /metrics de SAR_Server.py)
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values, q):
+    """
+    return: percentil "q" (0-100) de "values" por el metodo del rango mas cercano (None si esta vacia)
+
+    """
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[max(0, -(-q * len(values) // 100) - 1)]
+
+
+class Stage:
+
+    __slots__ = ('calls', 'total', 'own', 'items', 'nbytes', 'depth')
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.own = 0.0
+        self.items = 0
+        self.nbytes = 0
+        self.depth = 0
+
+
+class Profiler:
+    """
+    Tiempos y contadores por etapa de un SAR_Project.
+
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.stack = []  # tiempo de las etapas hijas de cada etapa en curso
+
+    def instrument(self, project, stages):
+        """
+        Envuelve los metodos "stages" (nombre --> funcion de tamaño o None, ver QUERY_STAGES) de "project".
+
+        """
+        for name, size in stages.items():
+            method = getattr(project, name, None)
+            if method is not None:
+                setattr(project, name, self.wrap(project, name, method, size))
+
+    def wrap(self, project, name, method, size):
+        stage = self.stages.setdefault(name, Stage())
+        stack = self.stack
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            if stage.depth > 0:
+                # llamada recursiva: ya se mide la externa
+                return method(*args, **kwargs)
+            stage.depth += 1
+            stack.append(0.0)
+            t0 = time.perf_counter()
+            try:
+                result = method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - t0
+                children = stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+                stage.depth -= 1
+                stage.calls += 1
+                stage.total += elapsed
+                stage.own += elapsed - children
+            if size is not None:
+                items, nbytes = size(project, args, result)
+                stage.items += items
+                stage.nbytes += nbytes
+            return result
+        return wrapper
+
+    def report(self):
+        """
+        Muestra las etapas ejecutadas, de mayor a menor tiempo propio.
+
+        """
+        print("========================================")
+        print("Profile:")
+        print("%-22s %8s %12s %12s %12s %12s" % ('stage', 'calls', 'total ms', 'own ms', 'items', 'KB'))
+        for name, stage in sorted(self.stages.items(), key=lambda item: -item[1].own):
+            if stage.calls > 0:
+                print("%-22s %8d %12.3f %12.3f %12d %12.1f" % (name, stage.calls, stage.total * 1000, stage.own * 1000,
+                                                                stage.items, stage.nbytes / 1024))
+        print("========================================")
@@ -0,0 +1,374 @@
+import re
+from abc import ABC, abstractmethod
+
+# Arbol de una consulta (AST) y su optimizacion.
+#
+# parse_query convierte la cadena en un arbol con nodos Term, Phrase, Range, Not, And y Or.
+# Los operadores AND y OR tienen la misma precedencia y se aplican de izquierda a derecha
+# (como en las versiones anteriores del buscador): "a OR b AND c" es "(a OR b) AND c".
+#
+# optimize reescribe el arbol:
+#   - las cadenas del mismo operador se aplanan en un unico nodo n-ario: And(And(a, b), c) --> And(a, b, c)
+#   - NOT NOT a --> a
+#   - los NOT dentro de un AND se convierten en diferencias: a AND NOT b AND NOT c --> Diff(a, [b, c])
+#   - los NOT dentro de un OR se sacan fuera: a OR NOT b --> NOT Diff(b, [a])
+# de modo que solo queda un NOT en la raiz o bajo un OR que no se pudo reescribir.
+
+
+class QuerySyntaxError(ValueError):
+    pass
+
+
+class QueryNode(ABC):
+    """
+    Nodo del arbol de una consulta.
+
+    Durante la planificacion y la evaluacion (SAR_Project.plan_query / evaluate) se rellenan:
+        "estimate": numero de noticias estimado, para ordenar los operandos
+        "posting": resultado del nodo, si ya se conoce (terminos o subconsultas en cache)
+        "cached": True si "posting" se obtuvo de la cache
+        "size": numero de noticias del resultado
+        "elapsed": tiempo de evaluacion del nodo (segundos)
+
+    """
+
+    def __init__(self):
+        self.estimate = 0
+        self.posting = None
+        self.cached = False
+        self.size = None
+        self.elapsed = 0.0
+
+    def operands(self):
+        return []
+
+    @abstractmethod
+    def key(self):
+        """
+        Clave normalizada del nodo: dos subconsultas equivalentes (p.e. "a AND b" y "b AND a") tienen la misma.
+
+        """
+
+    def label(self):
+        return self.key()
+
+
+class Term(QueryNode):
+    """
+    Termino, con comodines (* o ?) si "term" los contiene.
+
+    """
+
+    def __init__(self, term, field='article'):
+        super().__init__()
+        self.term = term
+        self.field = field
+
+    def is_wildcard(self):
+        return '*' in self.term or '?' in self.term
+
+    def key(self):
+        return '%s:%s' % (self.field, self.term)
+
+
+class Phrase(QueryNode):
+    """
+    Secuencia de terminos consecutivos ("fin de semana").
+
+    Con "slop" > 0 es una consulta de proximidad ("medalla oro"~2): los terminos deben aparecer
+    en orden y entre cada uno y el siguiente puede haber hasta "slop" terminos.
+
+    """
+
+    def __init__(self, terms, field='article', slop=0):
+        super().__init__()
+        self.terms = terms
+        self.field = field
+        self.slop = slop
+
+    def key(self):
+        if self.slop:
+            return '%s:"%s"~%d' % (self.field, ' '.join(self.terms), self.slop)
+        return '%s:"%s"' % (self.field, ' '.join(self.terms))
+
+
+class Range(QueryNode):
+    """
+    Rango de valores de un campo no tokenizado (date:[2015-03-01 TO 2015-03-31]), ambos extremos incluidos.
+
+    "hi" incluye tambien los valores que empiezan por "hi" (date:[2015-03 TO 2015-04] son marzo y abril).
+    Un extremo None ('*' en la consulta) es un rango abierto.
+
+    """
+
+    def __init__(self, lo, hi, field='date'):
+        super().__init__()
+        self.lo = lo
+        self.hi = hi
+        self.field = field
+
+    def key(self):
+        return '%s:[%s TO %s]' % (self.field, self.lo or '*', self.hi or '*')
+
+
+class Not(QueryNode):
+
+    def __init__(self, child):
+        super().__init__()
+        self.child = child
+
+    def operands(self):
+        return [self.child]
+
+    def key(self):
+        return 'NOT %s' % self.child.key()
+
+    def label(self):
+        return 'NOT'
+
+
+class And(QueryNode):
+
+    def __init__(self, children):
+        super().__init__()
+        self.children = children
+
+    def operands(self):
+        return self.children
+
+    def key(self):
+        return '(%s)' % ' AND '.join(sorted(child.key() for child in self.children))
+
+    def label(self):
+        return 'AND'
+
+
+class Or(QueryNode):
+
+    def __init__(self, children):
+        super().__init__()
+        self.children = children
+
+    def operands(self):
+        return self.children
+
+    def key(self):
+        return '(%s)' % ' OR '.join(sorted(child.key() for child in self.children))
+
+    def label(self):
+        return 'OR'
+
+
+class Diff(QueryNode):
+    """
+    Noticias de "positive" que no estan en ninguno de los nodos de "negatives".
+
+    """
+
+    def __init__(self, positive, negatives):
+        super().__init__()
+        self.positive = positive
+        self.negatives = negatives
+
+    def operands(self):
+        return [self.positive] + self.negatives
+
+    def key(self):
+        return '(%s MINUS %s)' % (self.positive.key(), ' OR '.join(sorted(neg.key() for neg in self.negatives)))
+
+    def label(self):
+        return 'MINUS'
+
+
+_TOKEN = re.compile(r'''\s*(?:
+      (?P<lpar>\()
+    | (?P<rpar>\))
+    | (?P<rfield>\w+):\[\s*(?P<lo>[^\s\]]+)\s+TO\s+(?P<hi>[^\s\]]+)\s*\]
+    | (?P<badrange>\w+:\[[^\]]*\]?)
+    | (?:(?P<field>\w+):)?(?:"(?P<phrase>[^"]*)"(?:~(?P<slop>\d+))?|(?P<term>[^\s()"]+))
+    )''', re.X)
+
+_OPERATORS = ('AND', 'OR', 'NOT')
+
+_WORD = re.compile(r'\w+')
+
+
+def tokenize_query(query, fields):
+    """
+    Divide una consulta en parentesis, operadores (AND, OR, NOT) y operandos (nodos Term, Phrase o Range).
+
+    param:  "query": cadena con la consulta
+            "fields": nombres de los campos validos como prefijo "campo:"
+
+    return: lista de tokens, los parentesis y operadores como cadenas
+
+    """
+    tokens = []
+    pos = 0
+    query = query.rstrip()
+    while pos < len(query):
+        match = _TOKEN.match(query, pos)
+        if match is None:
+            raise QuerySyntaxError("unexpected '%s' in query '%s'" % (query[pos:].strip(), query))
+        pos = match.end()
+        field, phrase, term = match.group('field', 'phrase', 'term')
+        if match.group('lpar'):
+            tokens.append('(')
+        elif match.group('rpar'):
+            tokens.append(')')
+        elif match.group('rfield'):
+            if match.group('rfield') not in fields:
+                raise QuerySyntaxError("unknown field '%s' in query '%s'" % (match.group('rfield'), query))
+            lo, hi = (None if bound == '*' else bound.lower() for bound in match.group('lo', 'hi'))
+            tokens.append(Range(lo, hi, match.group('rfield')))
+        elif match.group('badrange'):
+            # rango sin alguno de sus extremos o sin cerrar (date:[2015-03-01 TO])
+            raise QuerySyntaxError("malformed range '%s' in query '%s', expected field:[lo TO hi]" % (
+                match.group('badrange'), query))
+        elif field is None and term in _OPERATORS:
+            tokens.append(term)
+        else:
+            if field is not None and field not in fields:
+                # no es un campo, los ':' forman parte del termino o de la frase
+                if phrase is not None:
+                    phrase = '%s:%s' % (field, phrase)
+                else:
+                    term = '%s:%s' % (field, term)
+                field = None
+            field = field or 'article'
+            if phrase is not None:
+                words = _WORD.findall(phrase.lower())
+                if len(words) == 0:
+                    raise QuerySyntaxError("empty phrase in query '%s'" % query)
+                slop = int(match.group('slop') or 0)
+                # una frase de un solo termino ("cosa") es ese termino exacto, sin stemming
+                tokens.append(Phrase(words, field, slop if len(words) > 1 else 0))
+            else:
+                tokens.append(Term(term.lower(), field))
+    return tokens
+
+
+class _Parser:
+
+    def __init__(self, tokens, query):
+        self.tokens = tokens
+        self.query = query
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise QuerySyntaxError("unexpected end of query '%s'" % self.query)
+        self.pos += 1
+        return token
+
+    def expr(self):
+        node = self.unary()
+        while self.peek() is not None and self.peek() != ')':
+            op = self.peek()
+            if op in ('AND', 'OR'):
+                self.next()
+            else:
+                op = 'AND'  # dos operandos seguidos: AND implicito
+            right = self.unary()
+            node = And([node, right]) if op == 'AND' else Or([node, right])
+        return node
+
+    def unary(self):
+        if self.peek() == 'NOT':
+            self.next()
+            return Not(self.unary())
+        return self.primary()
+
+    def primary(self):
+        token = self.next()
+        if token == '(':
+            node = self.expr()
+            if self.next() != ')':
+                raise QuerySyntaxError("missing ')' in query '%s'" % self.query)
+            return node
+        if isinstance(token, QueryNode):
+            return token
+        raise QuerySyntaxError("unexpected '%s' in query '%s'" % (token, self.query))
+
+
+def parse_query(query, fields=('article',)):
+    """
+    Construye el arbol de una consulta.
+
+    param:  "query": cadena con la consulta
+            "fields": nombres de los campos validos como prefijo "campo:"
+
+    return: nodo raiz (Or vacio si la consulta no tiene operandos)
+
+    """
+    tokens = tokenize_query(query, fields)
+    if len(tokens) == 0:
+        return Or([])
+    parser = _Parser(tokens, query)
+    node = parser.expr()
+    if parser.peek() is not None:
+        raise QuerySyntaxError("unbalanced ')' in query '%s'" % query)
+    return node
+
+
+def optimize(node):
+    """
+    Aplica las reescrituras descritas al principio del modulo.
+
+    param:  "node": arbol devuelto por parse_query
+
+    return: arbol equivalente
+
+    """
+    if isinstance(node, Not):
+        child = optimize(node.child)
+        if isinstance(child, Not):
+            return child.child
+        return Not(child)
+
+    if isinstance(node, (And, Or)):
+        kind = type(node)
+        children = []
+        for child in map(optimize, node.children):
+            if isinstance(child, kind):
+                children.extend(child.children)
+            else:
+                children.append(child)
+        if len(children) == 1:
+            return children[0]
+
+        positives = [child for child in children if not isinstance(child, Not)]
+        negatives = [child.child for child in children if isinstance(child, Not)]
+
+        if kind is And:
+            # a AND (b MINUS c) AND NOT d --> (a AND b) MINUS (c, d)
+            for child in [child for child in positives if isinstance(child, Diff)]:
+                positives.remove(child)
+                if isinstance(child.positive, And):
+                    positives.extend(child.positive.children)
+                else:
+                    positives.append(child.positive)
+                negatives.extend(child.negatives)
+            if len(negatives) == 0:
+                return And(positives) if len(positives) > 1 else positives[0]
+            if len(positives) == 0:
+                # NOT a AND NOT b --> NOT (a OR b)
+                return Not(optimize(Or(negatives)))
+            positive = And(positives) if len(positives) > 1 else positives[0]
+            return Diff(positive, negatives)
+
+        if len(negatives) == 0:
+            return Or(positives)
+        # a OR NOT b OR NOT c --> NOT ((b AND c) MINUS a)
+        negative = optimize(And(negatives))
+        if len(positives) == 0:
+            return Not(negative)
+        if isinstance(negative, Diff):
+            return Not(Diff(negative.positive, negative.negatives + positives))
+        return Not(Diff(negative, positives))
+
+    return node
@@ -0,0 +1,608 @@
+import json
+import mmap
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+from collections.abc import Mapping
+
+from SAR_postings import PositionList, PostingList, decode_posting, decode_varint, encode_posting, encode_varint
+
+# Formato de un segmento:
+#
+#   MAGIC (8 bytes) | offset de la cabecera (uint64) | secciones ... | cabecera JSON
+#
+# La cabecera describe la configuracion del indice y, para cada seccion, su tipo y
+# la posicion (offset, longitud) de cada una de sus partes dentro del fichero.
+# Todas las partes estan alineadas a 8 bytes para poder leer los offsets y las tablas como
+# arrays directamente sobre el mmap, sin copiarlos.
+#
+# Las listas de enteros de las secciones "dict" y "lists" se guardan comprimidas segun su "encoding":
+#   "gaps":   listas ordenadas (posting lists), diferencias + variable byte (encode_posting)
+#   "varint": listas sin ordenar (frecuencias), variable byte (encode_varint)
+#   "uint32": sin comprimir (p.e. las palabras de un Bitmap, que no se comprimen)
+# y se decodifican (en una PostingList) al consultarlas.
+#
+# Tipos de seccion:
+#   "dict":    claves ordenadas (utf-8) --> lista de enteros
+#              partes: offsets de claves, claves, offsets de valores (en bytes), valores
+#   "table":   filas de "width" enteros (uint32), indexadas por su posicion
+#   "lists":   lista de listas de enteros indexada por su posicion
+#              partes: offsets (en bytes), valores
+#   "blobs":   lista de secuencias de bytes indexada por su posicion
+#              partes: offsets, bytes
+#   "strings": lista de cadenas indexada por su posicion
+#              partes: offsets, cadenas (utf-8)
+#
+# Los offsets de una seccion son uint32 si caben y si no uint64 (formato en "offsets" de la cabecera).
+#
+# El diccionario de terminos ("terms") es una seccion "strings" ordenada que comparten todos los
+# campos: el identificador de un termino es su posicion y las posting lists de cada campo son una
+# seccion "lists" indexada por identificador de termino (ver SegmentFieldIndex).
+
+MAGIC = b'SARSEG03'
+_HEADER = struct.Struct('<8sQ')
+_ALIGN = 8
+
+
+def _encode_uint32(values):
+    return array('I', values).tobytes()
+
+
+def _decode_uint32(data):
+    p = PostingList()
+    p.frombytes(data)
+    return p
+
+
+# codificaciones de las listas de enteros: nombre --> (codificar, decodificar en una PostingList)
+_ENCODINGS = {
+    'gaps': (encode_posting, decode_posting),
+    'varint': (encode_varint, decode_varint),
+    'uint32': (_encode_uint32, _decode_uint32),
+}
+
+
+def section_sizes(header):
+    """
+    return: bytes que ocupa en el fichero cada seccion (todas sus partes) de la cabecera de un segmento
+
+    """
+    return {name: sum(length for offset, length in section['parts']) for name, section in header['sections'].items()}
+
+
+def is_segment(filename):
+    """
+    Indica si "filename" es un segmento (y no, por ejemplo, un indice guardado con pickle).
+
+    """
+    with open(filename, 'rb') as fh:
+        return fh.read(len(MAGIC))[:6] == MAGIC[:6]
+
+
+class SegmentWriter:
+    """
+    Escribe un segmento seccion a seccion. La cabecera se escribe al final con close().
+
+    """
+
+    def __init__(self, filename):
+        self.fh = open(filename, 'wb')
+        self.fh.write(_HEADER.pack(MAGIC, 0))
+        self.header = {'byteorder': sys.byteorder, 'config': {}, 'sections': {}}
+
+    def set_config(self, **config):
+        """
+        Guarda valores simples (serializables en JSON) en la cabecera.
+
+        """
+        self.header['config'].update(config)
+
+    def _add(self, name, kind, parts, offsets=(), **meta):
+        """
+        Escribe las partes de una seccion. Las partes de las posiciones "offsets" son arrays de offsets,
+        que se guardan como uint32 si caben (y si no como uint64).
+
+        """
+        if len(offsets) > 0:
+            fmt = 'I' if all(parts[i][-1] < 1 << 32 for i in offsets) else 'Q'
+            parts = [array(fmt, part).tobytes() if i in offsets else part for i, part in enumerate(parts)]
+            meta['offsets'] = fmt
+        layout = []
+        for part in parts:
+            pad = -self.fh.tell() % _ALIGN
+            self.fh.write(b'\0' * pad)
+            layout.append((self.fh.tell(), len(part)))
+            self.fh.write(part)
+        self.header['sections'][name] = dict(kind=kind, parts=layout, **meta)
+
+    def add_dict(self, name, items, encoding='gaps'):
+        """
+        Añade una seccion "dict".
+
+        param:  "items": iterable de pares (clave, lista de enteros) ordenados por clave
+                "encoding": codificacion de las listas ("gaps" si estan ordenadas, "varint" o "uint32")
+
+        """
+        encode = _ENCODINGS[encoding][0]
+        keyoffs = array('Q', [0])
+        valoffs = array('Q', [0])
+        keys = bytearray()
+        values = bytearray()
+        for key, value in items:
+            keys += key.encode('utf-8')
+            keyoffs.append(len(keys))
+            values += encode(value)
+            valoffs.append(len(values))
+        self._add(name, 'dict', [keyoffs, bytes(keys), valoffs, bytes(values)], offsets=(0, 2), encoding=encoding)
+
+    def add_table(self, name, rows, width):
+        """
+        Añade una seccion "table".
+
+        param:  "rows": iterable de tuplas de "width" enteros
+
+        """
+        values = array('I')
+        for row in rows:
+            values.extend(row)
+        self._add(name, 'table', [values.tobytes()], width=width)
+
+    def add_lists(self, name, lists, encoding='gaps'):
+        """
+        Añade una seccion "lists".
+
+        param:  "lists": iterable de listas de enteros
+                "encoding": codificacion de las listas ("gaps" si estan ordenadas, "varint" o "uint32")
+
+        """
+        encode = _ENCODINGS[encoding][0]
+        offsets = array('Q', [0])
+        values = bytearray()
+        for value in lists:
+            values += encode(value)
+            offsets.append(len(values))
+        self._add(name, 'lists', [offsets, bytes(values)], offsets=(0,), encoding=encoding)
+
+    def add_blobs(self, name, blobs):
+        """
+        Añade una seccion "blobs".
+
+        param:  "blobs": iterable de bytes
+
+        """
+        offsets = array('Q', [0])
+        data = bytearray()
+        for blob in blobs:
+            data += blob
+            offsets.append(len(data))
+        self._add(name, 'blobs', [offsets, bytes(data)], offsets=(0,))
+
+    def add_strings(self, name, strings):
+        """
+        Añade una seccion "strings".
+
+        param:  "strings": iterable de cadenas
+
+        """
+        offsets = array('Q', [0])
+        blob = bytearray()
+        for string in strings:
+            blob += string.encode('utf-8')
+            offsets.append(len(blob))
+        self._add(name, 'strings', [offsets, bytes(blob)], offsets=(0,))
+
+    def close(self):
+        pad = -self.fh.tell() % _ALIGN
+        self.fh.write(b'\0' * pad)
+        offset = self.fh.tell()
+        self.fh.write(json.dumps(self.header).encode('utf-8'))
+        self.fh.seek(0)
+        self.fh.write(_HEADER.pack(MAGIC, offset))
+        self.fh.close()
+
+
+class Segment:
+    """
+    Segmento abierto con mmap. Las secciones se leen bajo demanda a traves de
+    SegmentTerms, SegmentDict, SegmentTable, SegmentStrings, ...; el sistema operativo solo carga las
+    paginas que se consultan y las comparte entre todos los procesos que abren el fichero.
+
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as fh:
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, offset = _HEADER.unpack_from(self.mm)
+        if magic[:6] != MAGIC[:6]:
+            raise ValueError("'%s' is not an index segment" % filename)
+        if magic != MAGIC:
+            raise ValueError("'%s' was written by another version of the indexer, index it again" % filename)
+        self.header = json.loads(self.mm[offset:].decode('utf-8'))
+        if self.header['byteorder'] != sys.byteorder:
+            raise ValueError("'%s' was written on a machine with a different byte order" % filename)
+        self.config = self.header['config']
+        self.sections = self.header['sections']
+        self.view = memoryview(self.mm)
+
+    def part(self, name, i, fmt='B'):
+        """
+        Devuelve la parte "i" de la seccion "name" como memoryview de formato "fmt" (sin copiar).
+
+        """
+        offset, length = self.sections[name]['parts'][i]
+        return self.view[offset:offset + length].cast(fmt)
+
+    def offsets(self, name, i):
+        """
+        Devuelve la parte "i" de la seccion "name", un array de offsets, como memoryview (sin copiar).
+
+        """
+        return self.part(name, i, self.sections[name]['offsets'])
+
+    def decoder(self, name):
+        """
+        return: funcion que decodifica (en una PostingList) las listas de la seccion "dict" o "lists" "name"
+
+        """
+        return _ENCODINGS[self.sections[name]['encoding']][1]
+
+
+class SegmentTerms:
+    """
+    Vista de solo lectura de una seccion con claves ordenadas ("strings" ordenada o las claves de un "dict").
+    Las busquedas son binarias sobre las claves en utf-8.
+
+    """
+
+    def __init__(self, segment, name):
+        self._keyoffs = segment.offsets(name, 0)
+        self._keys = segment.part(name, 1)
+        self._len = len(self._keyoffs) - 1
+
+    def key_at(self, i):
+        return bytes(self._keys[self._keyoffs[i]:self._keyoffs[i + 1]]).decode('utf-8')
+
+    def _lower_bound(self, target, lo=0):
+        """
+        Busqueda binaria: primera posicion cuya clave (en utf-8) no es menor que "target".
+
+        """
+        hi = self._len
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if bytes(self._keys[self._keyoffs[mid]:self._keyoffs[mid + 1]]) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, key):
+        """
+        Busqueda binaria de "key".
+
+        return: posicion de la clave o -1 si no esta
+
+        """
+        i = self._lower_bound(key.encode('utf-8'))
+        if i < self._len and self.key_at(i) == key:
+            return i
+        return -1
+
+    def prefix_range(self, prefix):
+        """
+        return: (lo, hi) tal que las claves de las posiciones lo..hi-1 son las que empiezan por "prefix"
+
+        """
+        target = prefix.encode('utf-8')
+        lo = self._lower_bound(target)
+        # ningun caracter en utf-8 contiene el byte 0xff
+        return lo, self._lower_bound(target + b'\xff', lo)
+
+    def key_range(self, lo, hi):
+        """
+        return: (i, j) tal que las claves de las posiciones i..j-1 son las que cumplen lo <= clave <= hi
+                o empiezan por "hi". Un extremo None no limita el rango.
+
+        """
+        i = 0 if lo is None else self._lower_bound(lo.encode('utf-8'))
+        j = self._len if hi is None else self._lower_bound(hi.encode('utf-8') + b'\xff', i)
+        return i, j
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def __iter__(self):
+        for i in range(self._len):
+            yield self.key_at(i)
+
+    def __len__(self):
+        return self._len
+
+
+class SegmentDict(SegmentTerms, Mapping):
+    """
+    Vista de solo lectura de una seccion "dict": se comporta como un diccionario
+    clave --> valor, donde el valor se construye con "decode" a partir de la PostingList guardada.
+
+    """
+
+    def __init__(self, segment, name, decode=None):
+        super().__init__(segment, name)
+        self._valoffs = segment.offsets(name, 2)
+        self._values = segment.part(name, 3)
+        self._decode_list = segment.decoder(name)
+        self._decode = decode
+
+    def value_at(self, i):
+        p = self._decode_list(self._values[self._valoffs[i]:self._valoffs[i + 1]])
+        if self._decode is not None:
+            return self._decode(p)
+        return p
+
+    def __getitem__(self, key):
+        i = self.find(key)
+        if i < 0:
+            raise KeyError(key)
+        return self.value_at(i)
+
+
+class SegmentTable(Mapping):
+    """
+    Vista de solo lectura de una seccion "table": posicion --> tupla de enteros.
+
+    """
+
+    def __init__(self, segment, name):
+        self._width = segment.sections[name]['width']
+        self._values = segment.part(name, 0, 'I')
+        self._len = len(self._values) // self._width
+
+    def __getitem__(self, i):
+        if not 0 <= i < self._len:
+            raise KeyError(i)
+        return tuple(self._values[i * self._width:(i + 1) * self._width])
+
+    def __iter__(self):
+        return iter(range(self._len))
+
+    def __len__(self):
+        return self._len
+
+
+class SegmentStrings(Mapping):
+    """
+    Vista de solo lectura de una seccion "strings": posicion --> cadena.
+
+    """
+
+    def __init__(self, segment, name):
+        self._offsets = segment.offsets(name, 0)
+        self._blob = segment.part(name, 1)
+        self._len = len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if not 0 <= i < self._len:
+            raise KeyError(i)
+        return bytes(self._blob[self._offsets[i]:self._offsets[i + 1]]).decode('utf-8')
+
+    def __iter__(self):
+        return iter(range(self._len))
+
+    def __len__(self):
+        return self._len
+
+
+class SegmentLists(Mapping):
+    """
+    Vista de solo lectura de una seccion "lists": posicion --> PostingList (decodificada al consultarla).
+
+    """
+
+    def __init__(self, segment, name):
+        self._offsets = segment.offsets(name, 0)
+        self._values = segment.part(name, 1)
+        self._decode = segment.decoder(name)
+        self._len = len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if not 0 <= i < self._len:
+            raise KeyError(i)
+        return self._decode(self._values[self._offsets[i]:self._offsets[i + 1]])
+
+    def nbytes(self, i):
+        """
+        return: bytes que ocupa la lista "i" codificada (0 si esta vacia), sin leerla
+
+        """
+        return self._offsets[i + 1] - self._offsets[i]
+
+    def __iter__(self):
+        return iter(range(self._len))
+
+    def __len__(self):
+        return self._len
+
+
+class SegmentFieldIndex(Mapping):
+    """
+    Indice invertido de un campo: termino --> PostingList.
+
+    Todos los campos comparten el diccionario de terminos ("terms", SegmentTerms); las posting lists
+    del campo estan en una seccion "lists" indexada por identificador de termino, vacias para los
+    terminos que no aparecen en el campo.
+
+    """
+
+    def __init__(self, terms, postings, size):
+        """
+        param:  "terms": diccionario de terminos compartido (SegmentTerms)
+                "postings": posting lists del campo (SegmentLists)
+                "size": numero de terminos del campo
+
+        """
+        self._terms = terms
+        self._postings = postings
+        self._size = size
+
+    def find(self, term):
+        """
+        return: identificador de "term" o -1 si no aparece en el campo
+
+        """
+        i = self._terms.find(term)
+        if i < 0 or self._postings.nbytes(i) == 0:
+            return -1
+        return i
+
+    def key_at(self, i):
+        return self._terms.key_at(i)
+
+    def prefix_range(self, prefix):
+        """
+        return: (lo, hi) con los identificadores de los terminos (de todos los campos) que empiezan por "prefix"
+
+        """
+        return self._terms.prefix_range(prefix)
+
+    def __getitem__(self, term):
+        i = self.find(term)
+        if i < 0:
+            raise KeyError(term)
+        return self._postings[i]
+
+    def __contains__(self, term):
+        return self.find(term) >= 0
+
+    def __iter__(self):
+        for i in range(len(self._terms)):
+            if self._postings.nbytes(i) > 0:
+                yield self._terms.key_at(i)
+
+    def __len__(self):
+        return self._size
+
+
+class SegmentBlobs(Mapping):
+    """
+    Vista de solo lectura de una seccion "blobs": posicion --> memoryview (sin copiar).
+
+    """
+
+    def __init__(self, segment, name):
+        self._offsets = segment.offsets(name, 0)
+        self._blob = segment.part(name, 1)
+        self._len = len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if not 0 <= i < self._len:
+            raise KeyError(i)
+        return self._blob[self._offsets[i]:self._offsets[i + 1]]
+
+    def __iter__(self):
+        return iter(range(self._len))
+
+    def __len__(self):
+        return self._len
+
+
+class SegmentPositions(Mapping):
+    """
+    Indice posicional de un segmento: termino --> PositionList.
+
+    Se guarda en dos secciones indexadas por identificador de termino (posicion del termino en "terms"):
+    "<name>.offsets" ("lists") y "<name>.data" ("blobs").
+
+    """
+
+    def __init__(self, segment, name, terms):
+        self._terms = terms
+        self._offsets = SegmentLists(segment, name + '.offsets')
+        self._data = SegmentBlobs(segment, name + '.data')
+
+    def __getitem__(self, term):
+        i = self._terms.find(term)
+        if i < 0:
+            raise KeyError(term)
+        return PositionList(self._offsets[i], self._data[i])
+
+    def __contains__(self, term):
+        return self._terms.find(term) >= 0
+
+    def __iter__(self):
+        return iter(self._terms)
+
+    def __len__(self):
+        return len(self._terms)
+
+
+class SegmentConcat(Mapping):
+    """
+    Concatenacion de varias tablas indexadas por posicion (una por segmento de un indice incremental):
+    posicion global --> valor de la tabla que la contiene.
+
+    "shift(s, value)", si se indica, transforma el valor leido del segmento s (p.e. para desplazar doc_ids).
+
+    """
+
+    def __init__(self, parts, shift=None):
+        self._parts = parts
+        self._bases = [0]
+        for part in parts:
+            self._bases.append(self._bases[-1] + len(part))
+        self._shift = shift
+
+    def locate(self, i):
+        """
+        return: (segmento, posicion dentro del segmento) de la posicion global i
+
+        """
+        if not 0 <= i < self._bases[-1]:
+            raise KeyError(i)
+        s = bisect_right(self._bases, i) - 1
+        return s, i - self._bases[s]
+
+    def __getitem__(self, i):
+        s, j = self.locate(i)
+        value = self._parts[s][j]
+        return value if self._shift is None else self._shift(s, value)
+
+    def __iter__(self):
+        return iter(range(self._bases[-1]))
+
+    def __len__(self):
+        return self._bases[-1]
+
+
+class SegmentUnion(Mapping):
+    """
+    Union de varios diccionarios (uno por segmento de un indice incremental): clave --> combinacion
+    de los valores de los segmentos que la contienen.
+
+    "combine(values)" recibe la lista de pares (segmento, valor) y devuelve el valor global.
+
+    """
+
+    def __init__(self, parts, combine):
+        self._parts = parts
+        self._combine = combine
+
+    def __getitem__(self, key):
+        values = [(s, part[key]) for s, part in enumerate(self._parts) if key in part]
+        if len(values) == 0:
+            raise KeyError(key)
+        return self._combine(values)
+
+    def __contains__(self, key):
+        return any(key in part for part in self._parts)
+
+    def __iter__(self):
+        seen = set()
+        for part in self._parts:
+            for key in part:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
+    def __len__(self):
+        return sum(1 for key in self)